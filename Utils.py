@@ -1,20 +1,48 @@
 import cv2 as cv
-import matplotlib.pyplot as plt
 
+from videostab.FrameStore import DEFAULT_RAM_BUDGET, FrameStore
 
-def load_video(path):
-    frames = []
+
+def load_video(path, ram_budget=DEFAULT_RAM_BUDGET, spill_dir=None):
+    """Decodes a whole video into a FrameStore: one contiguous (N, H, W, 3) buffer, spilled to a
+    memory-mapped file when larger than ram_budget. Returns an empty list if nothing could be decoded."""
+    try:
+        frames = FrameStore.from_video(path, ram_budget, spill_dir)
+    except IOError:
+        return []
+    return frames if frames is not None else []
+
+
+def iter_video(path):
+    """Yields the frames of a video one at a time, so only one decoded frame is alive at once."""
     capture = cv.VideoCapture(path)
+    if not capture.isOpened():
+        raise IOError(f"Could not open video '{path}'")
 
-    while capture.isOpened():
-        ret, frame = capture.read()
-        if not ret:
-            break
-        frames.append(frame)
+    try:
+        while True:
+            ret, frame = capture.read()
+            if not ret:
+                break
+            yield frame
+    finally:
+        capture.release()
+
+
+def get_video_properties(path):
+    """Returns (frame_count, fps, width, height) as reported by the container."""
+    capture = cv.VideoCapture(path)
+    if not capture.isOpened():
+        raise IOError(f"Could not open video '{path}'")
 
+    frame_count = int(capture.get(cv.CAP_PROP_FRAME_COUNT))
+    fps = capture.get(cv.CAP_PROP_FPS)
+    width = int(capture.get(cv.CAP_PROP_FRAME_WIDTH))
+    height = int(capture.get(cv.CAP_PROP_FRAME_HEIGHT))
     capture.release()
 
-    return frames
+    # Some containers report 0 fps, fall back to the old default
+    if not fps or fps <= 0:
+        fps = 30
 
-    out.release()
-    print(f"Video saved to {output_path}")
+    return frame_count, fps, width, height
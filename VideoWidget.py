@@ -1,4 +1,8 @@
+import atexit
 import sys
+import threading
+from functools import lru_cache
+
 import cv2 as cv
 import numpy as np
 from PyQt5.QtCore import Qt, QTimer, pyqtSignal
@@ -9,8 +13,164 @@ from PyQt5.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QPushButton
 
 import Utils
 
+# Frames rendered ahead of the playhead by each widget's prerender thread
+PRERENDER_AHEAD = 8
+
+
+@lru_cache(maxsize=16)
+def letterbox(frame_height, frame_width, display_width, display_height):
+    """(x, y, width, height) of a frame scaled to fit the display area, keeping its aspect ratio, centred."""
+    aspect_ratio = frame_width / frame_height
+
+    # Calculate new dimensions while maintaining aspect ratio
+    if aspect_ratio > 1:  # Width > Height
+        new_width = display_width
+        new_height = int(new_width / aspect_ratio)
+    else:  # Height > Width or square
+        new_height = display_height
+        new_width = int(new_height * aspect_ratio)
+
+    # Calculate position to center the image
+    y_offset = (display_height - new_height) // 2
+    x_offset = (display_width - new_width) // 2
+    return x_offset, y_offset, new_width, new_height
+
+
+class DisplaySlot:
+    """A display-size RGB buffer and the QImage that draws it, both allocated once and reused."""
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.buffer = np.zeros((height, width, 3), dtype=np.uint8)
+        self.image = QImage(self.buffer.data, width, height, width * 3, QImage.Format_RGB888)
+        self.frame_shape = None  # Source resolution the letterbox region was set up for
+        self.target = None
+
+    def render(self, frame):
+        """Resizes frame straight into the letterbox region, then converts it to RGB in place."""
+        if frame.shape[:2] != self.frame_shape:
+            x, y, w, h = letterbox(frame.shape[0], frame.shape[1], self.width, self.height)
+            self.buffer[:] = 0  # Black borders
+            self.target = self.buffer[y:y + h, x:x + w]
+            self.frame_shape = frame.shape[:2]
+        cv.resize(frame, (self.target.shape[1], self.target.shape[0]), dst=self.target,
+                  interpolation=cv.INTER_AREA)
+        cv.cvtColor(self.target, cv.COLOR_BGR2RGB, dst=self.target)
+
+
+class FramePrerenderer:
+    """Renders display-size frames ahead of the playhead on a background thread.
+
+    Owns a fixed pool of DisplaySlots: the displayed one, up to `ahead` prerendered ones and one
+    spare, so show() can always render a frame that wasn't prerendered (e.g. after a seek)."""
+
+    def __init__(self, width, height, ahead=PRERENDER_AHEAD):
+        self.slots = [DisplaySlot(width, height) for _ in range(ahead + 2)]
+        self.free = list(self.slots)
+        self.rendered = {}  # Frame index -> slot
+        self.failed = set()
+        self.displayed = None
+        self.frames = None
+        self.playhead = 0
+        self.ahead = ahead
+        self.generation = 0  # Bumped when the frames change, so in-flight renders are dropped
+        self.condition = threading.Condition(threading.RLock())
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name="prerender", daemon=True)
+        self.thread.start()
+        # A thread still inside OpenCV while the interpreter shuts down aborts the process
+        atexit.register(self.stop)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+
+    def set_frames(self, frames):
+        with self.condition:
+            self.frames = frames
+            self.playhead = 0
+            self.invalidate()
+
+    def invalidate(self):
+        """Drops prerendered frames, e.g. after the frames' content changed."""
+        with self.condition:
+            self.generation += 1
+            self.free.extend(self.rendered.values())
+            self.rendered.clear()
+            self.failed.clear()
+            self.condition.notify()
+
+    def window(self):
+        """Indices to keep prerendered: the frames after the playhead, wrapping like playback does."""
+        n = len(self.frames) if self.frames else 0
+        return [(self.playhead + k) % n for k in range(1, min(self.ahead, n - 1) + 1)]
+
+    def show(self, index):
+        """The slot holding frame index, rendered on the calling thread if it wasn't prerendered."""
+        with self.condition:
+            frames = self.frames
+            self.playhead = index
+            window = self.window()
+            for i in [i for i in self.rendered if i != index and i not in window]:
+                self.free.append(self.rendered.pop(i))
+            if self.displayed is not None:
+                self.free.append(self.displayed)
+            slot = self.rendered.pop(index, None)
+            prerendered = slot is not None
+            if not prerendered:
+                slot = self.free.pop()
+            self.displayed = slot
+            self.condition.notify()
+
+        if not prerendered:
+            slot.render(frames[index])
+        return slot
+
+    def next_target(self):
+        if not self.free:
+            return None
+        for i in self.window():
+            if i not in self.rendered and i not in self.failed:
+                return i
+        return None
+
+    def run(self):
+        while True:
+            with self.condition:
+                index = self.next_target()
+                while index is None and not self.stopped:
+                    self.condition.wait()
+                    index = self.next_target()
+                if self.stopped:
+                    return
+                slot = self.free.pop()
+                frames = self.frames
+                generation = self.generation
+
+            try:
+                slot.render(frames[index])
+                rendered = True
+            except Exception as e:
+                print(f"Warning: could not prerender frame {index}: {e}")
+                rendered = False
+
+            with self.condition:
+                if not rendered and generation == self.generation:
+                    self.failed.add(index)
+                if (rendered and generation == self.generation and index in self.window()
+                        and index not in self.rendered):
+                    self.rendered[index] = slot
+                else:
+                    self.free.append(slot)
+
+
 class VideoWidget(QWidget):
     frameChanged = pyqtSignal(int)
+    # The frames turned out shorter than their reported length (a container overstating its frame count)
+    lengthChanged = pyqtSignal(int)
 
     def __init__(self, frames):
         super().__init__()
@@ -24,47 +184,15 @@ class VideoWidget(QWidget):
 
         self.display_width = 800
         self.display_height = 800
+        self.prerenderer = FramePrerenderer(self.display_width, self.display_height)
+        self.prerenderer.set_frames(frames)
+
+        # Black background until a frame is shown
+        self.blank = DisplaySlot(self.display_width, self.display_height)
+        self.image = self.blank.image
 
         if frames and len(frames) > 0:
             self.change_frame(0)
-        else:
-            # Create a black background
-            background = np.zeros((self.display_height, self.display_width, 3), dtype=np.uint8)
-            self.image = QImage(
-                background.data,
-                background.shape[1],
-                background.shape[0],
-                background.shape[1] * 3,
-                QImage.Format_RGB888
-            )
-
-    def resize_frame(self, frame):
-        """Resize frame to fit in display area while maintaining aspect ratio"""
-        h, w = frame.shape[:2]
-        aspect_ratio = w / h
-
-        # Calculate new dimensions while maintaining aspect ratio
-        if aspect_ratio > 1:  # Width > Height
-            new_width = self.display_width
-            new_height = int(new_width / aspect_ratio)
-        else:  # Height > Width or square
-            new_height = self.display_height
-            new_width = int(new_height * aspect_ratio)
-
-        # Resize the frame
-        resized_frame = cv.resize(frame, (new_width, new_height), interpolation=cv.INTER_AREA)
-
-        # Create a black background
-        background = np.zeros((self.display_height, self.display_width, 3), dtype=np.uint8)
-
-        # Calculate position to center the image
-        y_offset = (self.display_height - new_height) // 2
-        x_offset = (self.display_width - new_width) // 2
-
-        # Place the resized image on the background
-        background[y_offset:y_offset + new_height, x_offset:x_offset + new_width] = resized_frame
-
-        return background
 
     def update_frame(self):
         if not self.frames or self.current_index >= len(self.frames) - 1:
@@ -79,9 +207,15 @@ class VideoWidget(QWidget):
     def set_frames(self,frames):
         self.frames = frames
         self.current_index = 0
+        self.prerenderer.set_frames(frames)
         if frames and len(frames) > 0:
             self.change_frame(0)
 
+    def refresh(self):
+        """Redraws the current frame after the frames' content changed (e.g. re-smoothed)."""
+        self.prerenderer.invalidate()
+        self.change_frame(self.current_index)
+
     def paintEvent(self, event):
         if hasattr(self, 'image'):
             painter = QPainter(self)
@@ -95,24 +229,19 @@ class VideoWidget(QWidget):
         self.timer.stop()
 
     def change_frame(self, index):
-        if not self.frames or not (0 <= index < len(self.frames)):
+        if not self.frames or index < 0:
             return
 
-        self.current_index = index
-        frame = self.frames[self.current_index].copy()
-
-        # Resize frame maintaining aspect ratio
-        frame = self.resize_frame(frame)
-
-        # Convert to RGB for display
-        frame = cv.cvtColor(frame, cv.COLOR_BGR2RGB)
-
-        self.image = QImage(
-            frame.data,
-            frame.shape[1],
-            frame.shape[0],
-            frame.shape[1] * 3,
-            QImage.Format_RGB888
-        )
+        try:
+            # Letterboxed RGB frame in a reused buffer, usually already prerendered
+            slot = self.prerenderer.show(min(index, len(self.frames) - 1))
+        except IndexError:
+            # The frames ended early and now report their real length: show the last one instead
+            slot = self.prerenderer.show(len(self.frames) - 1)
+        if index >= len(self.frames):
+            self.lengthChanged.emit(len(self.frames))
+            index = len(self.frames) - 1
 
+        self.current_index = index
+        self.image = slot.image
         self.update()
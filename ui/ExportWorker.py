@@ -0,0 +1,59 @@
+import os
+import threading
+
+from PyQt5.QtCore import QObject, pyqtSignal, QRunnable, pyqtSlot
+
+from videostab.Export import DEFAULT_FOURCC, export_frames, export_stabilized
+
+
+class ExportSignals(QObject):
+    finished = pyqtSignal()
+    error = pyqtSignal(str)
+    # Progress: current step (string), percentage (int)
+    progress = pyqtSignal(str, int)
+    # Result: output path, frames written, whether the export was cancelled
+    result = pyqtSignal(str, int, bool)
+
+
+class ExportWorker(QRunnable):
+    """Writes the stabilized video on the Qt thread pool, off the GUI thread; cancel() stops it between frames.
+
+    With video_path and transforms the source is re-decoded and warped through the streaming
+    pipeline; otherwise the frames sequence (e.g. a lazy StabilizedFrames) is encoded as it is
+    iterated. fps defaults to the source's frame rate."""
+
+    def __init__(self, output_path, frames=None, video_path=None, transforms=None, fps=None,
+                 fourcc=DEFAULT_FOURCC, workers=None):
+        super().__init__()
+        self.export_signals = ExportSignals()
+        self.output_path = output_path
+        self.frames = frames
+        self.video_path = video_path
+        self.transforms = transforms
+        self.fps = fps
+        self.fourcc = fourcc
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def report_progress(self, done, total):
+        if done % 10 == 0 or done == total:
+            self.export_signals.progress.emit(f"Exporting frame {done}/{total}", int(100 * done / total))
+
+    @pyqtSlot()
+    def run(self):
+        try:
+            if self.video_path is not None and self.transforms is not None:
+                written = export_stabilized(self.video_path, self.transforms, self.output_path, self.fourcc,
+                                            self.fps, self.workers, self.report_progress, self.cancel_event)
+            else:
+                written = export_frames(self.frames, self.output_path, self.fps or 30, self.fourcc,
+                                        self.report_progress, self.cancel_event)
+            self.export_signals.result.emit(self.output_path, written, self.cancel_event.is_set())
+        except Exception as e:
+            print(f"Error during export: {e}")
+            self.export_signals.error.emit(f"Error saving video: {e}")
+        finally:
+            self.export_signals.finished.emit()
@@ -1,13 +1,17 @@
 from PyQt5.QtCore import Qt, QThreadPool, pyqtSlot
-import cv2 as cv
-from PyQt5.QtCore import Qt, QThreadPool, pyqtSlot
 from PyQt5.QtWidgets import (QVBoxLayout, QHBoxLayout, QSlider,
                              QPushButton, QMainWindow, QWidget, QFileDialog,
-                             QProgressBar, QLabel)
+                             QProgressBar, QLabel, QSpinBox, QComboBox)
 
-import Utils
 from VideoWidget import VideoWidget
+from ui.ExportWorker import ExportWorker
+from ui.SmoothingWorker import SmoothingWorker
 from ui.StabilizationWorker import StabilizationWorker
+from videostab.Crop import CROP_MODES
+from videostab.Export import DEFAULT_FOURCC, FOURCCS
+from videostab.FrameSource import FrameSource
+from videostab.TransformCache import TransformCache
+from videostab.Trajectory import SMOOTHING_METHODS
 
 
 class MainWindow(QMainWindow):
@@ -21,15 +25,29 @@ class MainWindow(QMainWindow):
 
         # --- Internal State ---
         self.updating_ui = False  # Flag to prevent recursive UI updates
+        self.video_path = None  # File the current frames were loaded from
         self.frames_before = None
         self.frames_after = None
         self.worker = None  # Reference to the stabilization worker
+        self.export_worker = None  # Reference to the running export, if any
+        self.smoothing_worker = None  # Reference to the running re-smooth, if any
+        self.resmooth_requested = False  # The settings changed during it: re-smooth once it is done
+        self.restart_requested = False  # Start a new run once the cancelled one has stopped
         self.thread_pool = QThreadPool()  # Thread pool for the worker
+        try:
+            # Re-stabilizing the same video with other settings reuses its motion transforms
+            self.transform_cache = TransformCache()
+        except OSError as e:
+            print(f"Transform cache disabled: {e}")
+            self.transform_cache = None
 
         # Stabilization results data
-        self.dx, self.dy, self.dr = None, None, None
-        self.smoothed_dx, self.smoothed_dy, self.smoothed_dr = None, None, None
-        self.correction_transforms = None
+        self.path = None  # Raw cumulative (dx, dy, dr) path, (N, 3)
+        self.smoothed_path = None  # Smoothed path, (N, 3)
+        self.correction_transforms = None  # (N, 2, 3)
+        # Raw frame transforms of the loaded video estimated so far: all of them after a completed
+        # run, the first pairs after a cancelled one. The next run continues from them.
+        self.frame_transforms = None
 
         # --- UI Elements ---
 
@@ -39,6 +57,25 @@ class MainWindow(QMainWindow):
         self.stabilize_button = QPushButton("Stabilize")
         self.play_button = QPushButton("Play")
         self.stop_button = QPushButton("Stop")
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.setVisible(False)
+        # Codec of the saved video
+        self.codec_combo = QComboBox()
+        self.codec_combo.addItems(FOURCCS)
+        self.codec_combo.setCurrentText(DEFAULT_FOURCC)
+
+        # Smoothing strength; changing it after stabilization only re-smooths the path
+        # and re-warps the frames being displayed
+        self.sigma_label = QLabel("Smoothing (sigma):")
+        self.sigma_spin = QSpinBox()
+        self.sigma_spin.setRange(1, 200)
+        self.sigma_spin.setValue(10)
+        # Gaussian (sigma) or L1-optimal path (constant/linear/parabolic segments within a crop window)
+        self.method_combo = QComboBox()
+        self.method_combo.addItems(SMOOTHING_METHODS)
+        # Autocrop zooms in on the largest window without black borders, applied like the smoothing
+        self.crop_combo = QComboBox()
+        self.crop_combo.addItems(CROP_MODES)
 
         # Initial button states
         self.save_button.setEnabled(False)
@@ -85,7 +122,12 @@ class MainWindow(QMainWindow):
         button_layout = QHBoxLayout()
         button_layout.addWidget(self.load_button)
         button_layout.addWidget(self.save_button)
+        button_layout.addWidget(self.codec_combo)
         button_layout.addWidget(self.stabilize_button)
+        button_layout.addWidget(self.method_combo)
+        button_layout.addWidget(self.crop_combo)
+        button_layout.addWidget(self.sigma_label)
+        button_layout.addWidget(self.sigma_spin)
         button_layout.addStretch()  # Push play/stop to the right
         button_layout.addWidget(self.play_button)
         button_layout.addWidget(self.stop_button)
@@ -122,6 +164,7 @@ class MainWindow(QMainWindow):
         progress_layout = QHBoxLayout()
         progress_layout.addWidget(self.progress_label, 1)  # Label takes some space
         progress_layout.addWidget(self.progress_bar, 4)  # Bar takes more space
+        progress_layout.addWidget(self.cancel_button)
         self.main_layout.addLayout(progress_layout)
 
         # Add stretch at the bottom
@@ -138,11 +181,17 @@ class MainWindow(QMainWindow):
         self.stabilize_button.clicked.connect(self.stabilize_video)
         self.play_button.clicked.connect(self.play_video)
         self.stop_button.clicked.connect(self.stop_video)
+        self.cancel_button.clicked.connect(self.cancel_running)
+        self.sigma_spin.valueChanged.connect(lambda _: self.update_smoothing())
+        self.method_combo.currentTextChanged.connect(self.update_method)
+        self.crop_combo.currentTextChanged.connect(lambda _: self.update_smoothing())
 
         # Connect frame changes from, video widget to slider update
         self.before_video.frameChanged.connect(self.update_slider_from_video)
         # Connect slider value changes to video frame update
         self.slider.valueChanged.connect(self.update_video_from_slider)
+        self.before_video.lengthChanged.connect(self.update_slider_length)
+        self.after_video.lengthChanged.connect(self.update_slider_length)
 
         self.apply_styles()
 
@@ -166,6 +215,7 @@ class MainWindow(QMainWindow):
         self.stabilize_button.setStyleSheet(button_style)
         self.play_button.setStyleSheet(button_style)
         self.stop_button.setStyleSheet(button_style)
+        self.cancel_button.setStyleSheet(button_style)
 
         # Main background
         self.setStyleSheet("QMainWindow { background-color:#FFF8DC; }")
@@ -174,6 +224,7 @@ class MainWindow(QMainWindow):
         label_style = "QLabel { color: #5f4c3a; font-weight: bold; }"
         self.before_label.setStyleSheet(label_style)
         self.after_label.setStyleSheet(label_style)
+        self.sigma_label.setStyleSheet("QLabel { color: #5f4c3a; }")
         self.progress_label.setStyleSheet("QLabel { color: #333333; }")  # Progress text color
 
     # --- Action Methods ---
@@ -192,22 +243,23 @@ class MainWindow(QMainWindow):
             try:
                 self.hide_error()  # Hide previous errors on new load attempt
                 print(f"Loading video from: {selected_file}")
-                # Load frames
-                loaded_frames = Utils.load_video(selected_file)
+                # Frames are decoded on demand, so even long videos open instantly
+                self.release_frames()
+                loaded_frames = FrameSource(selected_file)
 
-                if not loaded_frames:
-                    raise ValueError("No frames could be loaded from the selected file.")
                 if len(loaded_frames) <= 1:
+                    loaded_frames.close()
                     raise ValueError("Video must contain at least two frames.")
 
                 # --- Successfully loaded ---
                 self.frames_before = loaded_frames
+                self.video_path = selected_file
                 print(f"Successfully loaded {len(self.frames_before)} frames.")
 
                 # Reset stabilization results
                 self.frames_after = None
-                self.dx, self.dy, self.dr = None, None, None  # Clear plot data too
-                self.smoothed_dx, self.smoothed_dy, self.smoothed_dr = None, None, None
+                self.frame_transforms = None
+                self.path, self.smoothed_path = None, None  # Clear plot data too
 
                 # Update 'Before' video widget
                 self.before_video.set_frames(self.frames_before)
@@ -233,7 +285,8 @@ class MainWindow(QMainWindow):
                 print(error_msg)
                 self.show_error(error_msg)
                 # Reset UI to safe state on load failure
-                self.frames_before = None
+                self.release_frames()
+                self.video_path = None
                 self.frames_after = None
                 self.before_video.set_frames(None)
                 self.after_video.set_frames(None)
@@ -248,6 +301,12 @@ class MainWindow(QMainWindow):
                 self.slider.setVisible(False)
                 return  # Stop further execution in load_video
 
+    def release_frames(self):
+        """Closes the current video source (its decoder and prefetch thread)."""
+        if self.frames_before is not None:
+            self.frames_before.close()
+        self.frames_before = None
+
     def stabilize_video(self):
         """Starts the video stabilization process in a worker thread."""
         if not self.frames_before:
@@ -255,14 +314,20 @@ class MainWindow(QMainWindow):
             return
 
         if self.worker is not None:
-            self.show_error("Stabilization is already in progress.")
+            # A new run pre-empts the current one: it is cancelled, and this one starts with the
+            # current settings (continuing from the motion estimated so far) once it has stopped
+            self.restart_requested = True
+            self.progress_label.setText("Restarting with the new settings...")
+            self.worker.cancel()
+            return
+        if self.export_worker is not None:
+            self.show_error("Wait for the export to finish, or cancel it.")
             return
 
         # Reset previous results and UI state for stabilization
         self.frames_after = None
         self.after_video.set_frames(None)
         self.save_button.setEnabled(False)
-        self.stabilize_button.setEnabled(False)  # Disable during processing
         self.load_button.setEnabled(False)  # Disable during processing
         # self.play_button.setEnabled(False)  # Disable playback during processing
         # self.stop_button.setEnabled(False)
@@ -273,16 +338,22 @@ class MainWindow(QMainWindow):
         self.progress_label.setText("Starting stabilization...")
         self.progress_bar.setVisible(True)
         self.progress_label.setVisible(True)
+        self.cancel_button.setVisible(True)
 
         # --- Prepare and start worker ---
-        sigma_value = 10
-        self.worker = StabilizationWorker(self.frames_before, sigma=sigma_value)
+        sigma_value = self.sigma_spin.value()
+        # lazy_warp: the 'After' panel warps frames on demand instead of holding a second copy of the video
+        self.worker = StabilizationWorker(self.frames_before, method=self.method_combo.currentText(),
+                                          crop=self.crop_combo.currentText(), sigma=sigma_value, video_path=self.video_path,
+                                          transform_cache=self.transform_cache, lazy_warp=True,
+                                          resume_transforms=self.frame_transforms)
 
         # Connect signals
         self.worker.stabilization_signals.progress.connect(self.update_progress)
         self.worker.stabilization_signals.result.connect(self.stabilization_completed)
         self.worker.stabilization_signals.finished.connect(self.stabilization_finished)
         self.worker.stabilization_signals.error.connect(self.stabilization_error)
+        self.worker.stabilization_signals.cancelled.connect(self.stabilization_cancelled)
 
         print("Starting stabilization worker thread...")
         # Start the worker in the global thread pool
@@ -307,32 +378,74 @@ class MainWindow(QMainWindow):
             if not selected_file: return  # User cancelled
 
             print(f"Saving stabilized video to: {selected_file}")
-            try:
-                height, width, _ = self.frames_after[0].shape
-                # Use mp4v codec for MP4 files, check compatibility if saving other formats
-                fourcc = cv.VideoWriter_fourcc(*'mp4v')
-
-                fps = 30
-                out = cv.VideoWriter(selected_file, fourcc, fps, (width, height))
-
-                if not out.isOpened():
-                    raise IOError(f"Could not open video writer for '{selected_file}'")
-
-                for i, frame in enumerate(self.frames_after):
-                    # Ensure frame is BGR format for VideoWriter
-                    if frame.ndim == 3 and frame.shape[2] == 3:
-                        out.write(frame)
-                    else:
-                        print(f"Warning: Skipping invalid frame {i} during save.")
-
-                out.release()
-                print(f"Video saved successfully to {selected_file}")
+            # Encoded on the thread pool at the source frame rate, streamed from the source video
+            # and the current correction transforms
+            self.export_worker = ExportWorker(selected_file, frames=self.frames_after, video_path=self.video_path,
+                                              transforms=self.correction_transforms,
+                                              fps=getattr(self.frames_before, 'fps', None),
+                                              fourcc=self.codec_combo.currentText())
+            self.export_worker.export_signals.progress.connect(self.update_progress)
+            self.export_worker.export_signals.result.connect(self.export_completed)
+            self.export_worker.export_signals.error.connect(self.show_error)
+            self.export_worker.export_signals.finished.connect(self.export_finished)
+
+            self.hide_error()
+            self.save_button.setEnabled(False)
+            self.stabilize_button.setEnabled(False)
+            self.load_button.setEnabled(False)
+            self.progress_bar.setValue(0)
+            self.progress_label.setText("Starting export...")
+            self.progress_bar.setVisible(True)
+            self.progress_label.setVisible(True)
+            self.cancel_button.setVisible(True)
+            self.thread_pool.start(self.export_worker)
+
+    def cancel_export(self):
+        if self.export_worker is not None:
+            self.progress_label.setText("Cancelling export...")
+            self.export_worker.cancel()
+
+    def cancel_stabilization(self):
+        if self.worker is not None:
+            self.restart_requested = False
+            self.progress_label.setText("Cancelling stabilization...")
+            self.worker.cancel()
+
+    def cancel_running(self):
+        """Cancel button: stops the export or the stabilization in progress."""
+        self.cancel_export()
+        self.cancel_stabilization()
+
+    def update_method(self, method):
+        self.sigma_spin.setEnabled(method == "Gaussian")  # The L1 path has no sigma
+        self.update_smoothing()
+
+    def update_smoothing(self):
+        """Re-smooths and re-crops the stabilized path with the current settings, without re-running motion estimation.
+
+        Runs on the thread pool, so the GUI stays responsive while the L1 LPs are solved; settings
+        changed meanwhile are applied by one more re-smooth once it is done. Only the frames shown
+        from now on are warped with the new corrections. During a run, the run is restarted with the
+        new settings."""
+        if self.worker is not None:
+            self.stabilize_video()
+            return
+        if self.path is None or not self.frames_after:
+            return  # Used by the next stabilization run
 
+        if self.smoothing_worker is not None:
+            # Settings changed faster than the path is re-smoothed: only the latest ones are applied
+            self.resmooth_requested = True
+            return
 
-            except Exception as e:
-                error_msg = f"Error saving video: {e}"
-                print(error_msg)
-                self.show_error(error_msg)
+        height, width = self.frames_before[0].shape[:2]
+        self.resmooth_requested = False
+        self.smoothing_worker = SmoothingWorker(self.path, self.method_combo.currentText(), self.sigma_spin.value(),
+                                                (width, height), self.crop_combo.currentText())
+        self.smoothing_worker.smoothing_signals.result.connect(self.smoothing_completed)
+        self.smoothing_worker.smoothing_signals.error.connect(self.show_error)
+        self.smoothing_worker.smoothing_signals.finished.connect(self.smoothing_finished)
+        self.thread_pool.start(self.smoothing_worker)
 
     def play_video(self):
         """Starts playback in both video widgets."""
@@ -353,9 +466,8 @@ class MainWindow(QMainWindow):
 
     # --- Signal Handling Slots ---
 
-    @pyqtSlot(list, list, list, list, list, list, list, list)
-    def stabilization_completed(self, stabilized_frames, correction_transforms,
-                                dx, dy, dr, smoothed_dx, smoothed_dy, smoothed_dr):
+    @pyqtSlot(object, object, object, object)
+    def stabilization_completed(self, stabilized_frames, correction_transforms, path, smoothed_path):
         """Handles the 'result' signal from the worker."""
         print("Stabilization data received from worker.")
 
@@ -365,10 +477,10 @@ class MainWindow(QMainWindow):
             return
 
         # Store the results
+        self.frame_transforms = self.worker.stabilizer.frame_transforms
         self.frames_after = stabilized_frames
         self.correction_transforms = correction_transforms
-        self.dx, self.dy, self.dr = dx, dy, dr
-        self.smoothed_dx, self.smoothed_dy, self.smoothed_dr = smoothed_dx, smoothed_dy, smoothed_dr
+        self.path, self.smoothed_path = path, smoothed_path
 
         # Update the 'After' video widget
         self.after_video.set_frames(self.frames_after)
@@ -383,6 +495,7 @@ class MainWindow(QMainWindow):
         print("Stabilization worker thread has finished.")
         self.progress_bar.setVisible(False)
         self.progress_label.setVisible(False)
+        self.cancel_button.setVisible(False)
 
         # Re-enable buttons that were disabled during processing
         self.stabilize_button.setEnabled(True)
@@ -392,6 +505,48 @@ class MainWindow(QMainWindow):
             self.stop_button.setEnabled(True)
 
         self.worker = None  # Clear the worker reference
+        if self.restart_requested:
+            self.restart_requested = False
+            self.stabilize_video()
+
+    @pyqtSlot(object)
+    def stabilization_cancelled(self, frame_transforms):
+        """Keeps the motion estimated before the cancellation for the next run."""
+        if self.frame_transforms is None or len(frame_transforms) > len(self.frame_transforms):
+            self.frame_transforms = frame_transforms
+        print(f"Kept {len(frame_transforms)} frame transforms for the next run.")
+
+    @pyqtSlot(str, int, bool)
+    def export_completed(self, output_path, written, cancelled):
+        if cancelled:
+            print(f"Export to {output_path} cancelled after {written} frames.")
+        else:
+            print(f"Video saved successfully to {output_path} ({written} frames)")
+
+    @pyqtSlot()
+    def export_finished(self):
+        self.progress_bar.setVisible(False)
+        self.progress_label.setVisible(False)
+        self.cancel_button.setVisible(False)
+        self.save_button.setEnabled(self.frames_after is not None)
+        self.stabilize_button.setEnabled(self.frames_before is not None)
+        self.load_button.setEnabled(True)
+        self.export_worker = None
+
+    @pyqtSlot(object, object, object)
+    def smoothing_completed(self, path, smoothed_path, correction_transforms):
+        """Applies a re-smooth to the frames shown from now on, unless it is already outdated."""
+        if self.resmooth_requested or path is not self.path or not self.frames_after:
+            return
+        self.smoothed_path = smoothed_path
+        self.correction_transforms = correction_transforms
+        self.frames_after.set_transforms(correction_transforms)
+        self.after_video.refresh()
+
+    def smoothing_finished(self):
+        self.smoothing_worker = None
+        if self.resmooth_requested:
+            self.update_smoothing()
 
     @pyqtSlot(str)
     def stabilization_error(self, error_message):
@@ -425,6 +580,12 @@ class MainWindow(QMainWindow):
 
             self.updating_ui = False
 
+    @pyqtSlot(int)
+    def update_slider_length(self, n_frames):
+        """Shrinks the slider when a video turns out to have fewer frames than its container claimed."""
+        if 0 < n_frames <= self.slider.maximum():
+            self.slider.setMaximum(n_frames - 1)
+
     @pyqtSlot(int)
     def update_video_from_slider(self, index):
         """Updates video frames when the slider is moved manually."""
@@ -450,6 +611,12 @@ class MainWindow(QMainWindow):
 
             self.updating_ui = False
 
+    def closeEvent(self, event):
+        # Don't leave an export or a stabilization running in the background after the window is gone
+        self.cancel_running()
+        self.thread_pool.waitForDone()
+        super().closeEvent(event)
+
     # --- Helper Methods ---
 
     def show_error(self, message):
@@ -0,0 +1,43 @@
+import os
+
+from PyQt5.QtCore import QObject, pyqtSignal, QRunnable, pyqtSlot
+
+from videostab.Crop import crop_corrections
+from videostab.Trajectory import smooth_corrections
+
+
+class SmoothingSignals(QObject):
+    finished = pyqtSignal()
+    error = pyqtSignal(str)
+    # Result: the raw path it smoothed, smoothed path, cropped (N, 2, 3) correction transforms
+    result = pyqtSignal(object, object, object)
+
+
+class SmoothingWorker(QRunnable):
+    """Re-smooths and re-crops a raw camera path on the Qt thread pool, off the GUI thread.
+
+    The L1 method solves its window LPs on `workers` processes (all cores by default), as a
+    stabilization run does."""
+
+    def __init__(self, path, method, sigma, frame_size, crop, workers=None):
+        super().__init__()
+        self.smoothing_signals = SmoothingSignals()
+        self.path = path
+        self.method = method
+        self.sigma = sigma
+        self.frame_size = frame_size
+        self.crop = crop
+        self.workers = workers if workers is not None else os.cpu_count()
+
+    @pyqtSlot()
+    def run(self):
+        try:
+            smoothed_path, corrections = smooth_corrections(self.path, self.method, self.sigma,
+                                                            frame_size=self.frame_size, workers=self.workers)
+            corrections, _ = crop_corrections(corrections, self.frame_size, self.crop)
+            self.smoothing_signals.result.emit(self.path, smoothed_path, corrections)
+        except Exception as e:
+            print(f"Error during smoothing: {e}")
+            self.smoothing_signals.error.emit(f"Smoothing failed: {e}")
+        finally:
+            self.smoothing_signals.finished.emit()
@@ -0,0 +1,100 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2 as cv
+
+from videostab.Estimators import DEFAULT_ESTIMATOR, DEFAULT_SKIP_INTERVAL
+from videostab.Instrumentation import Recorder
+from videostab.Stabilizer import Stabilizer
+from videostab.TransformCache import DEFAULT_MAX_BYTES, TransformCache
+
+
+def init_process(cv_threads):
+    """Pool initializer: caps OpenCV's own thread pool so N processes don't oversubscribe the cores."""
+    cv.setNumThreads(cv_threads)
+
+
+def output_names(input_paths):
+    """Name of each input's output, relative to the output directory.
+
+    The input's base name, or, when two inputs share one (in/a/clip.mp4, in/b/clip.mp4), its path
+    relative to the inputs' common directory, so no two workers write the same file."""
+    names = [os.path.basename(path) for path in input_paths]
+    if len(set(names)) == len(names):
+        return names
+    paths = [os.path.abspath(path) for path in input_paths]
+    root = os.path.commonpath([os.path.dirname(path) for path in paths])
+    return [os.path.relpath(path, root) for path in paths]
+
+
+def stabilize_file(input_path, output_path, method="Gaussian", sigma=50, estimation_workers=1,
+                   estimation_scale=None, warp_workers=1, cache_dir=None, cache_max_bytes=DEFAULT_MAX_BYTES,
+                   trace_path=None, crop="Autocrop", output_size=None, estimator=DEFAULT_ESTIMATOR,
+                   skip_interval=DEFAULT_SKIP_INTERVAL):
+    """Stabilizes one file in streaming mode. Returns (n_frames, seconds).
+
+    With trace_path the run is instrumented: a Chrome trace is written there (also when it fails)
+    and a summary printed."""
+    start = time.perf_counter()
+    transform_cache = TransformCache(cache_dir, cache_max_bytes) if cache_dir else None
+    recorder = Recorder(label=input_path) if trace_path else None
+    stabilizer = Stabilizer(None, method=method, sigma=sigma, video_path=input_path, output_path=output_path,
+                            estimation_workers=estimation_workers, estimation_scale=estimation_scale,
+                            warp_workers=warp_workers, transform_cache=transform_cache, recorder=recorder,
+                            crop=crop, output_size=output_size, estimator=estimator,
+                            skip_interval=skip_interval)
+    try:
+        n_frames = stabilizer.stabilize()
+    finally:
+        if recorder is not None:
+            recorder.write_trace(trace_path)
+            print(recorder.summary())
+    return n_frames, time.perf_counter() - start
+
+
+def run_batch(input_paths, output_dir, jobs=None, method="Gaussian", sigma=50, cv_threads=None,
+              estimation_workers=None, estimation_scale=None, warp_workers=None, cache_dir=None,
+              cache_max_bytes=DEFAULT_MAX_BYTES, trace_dir=None, crop="Autocrop", output_size=None,
+              estimator=DEFAULT_ESTIMATOR, skip_interval=DEFAULT_SKIP_INTERVAL):
+    """Stabilizes every input file in its own worker process.
+
+    Prints per-file throughput and returns the number of files that failed."""
+    # The same file given twice (e.g. by overlapping globs) is stabilized once
+    input_paths = list({os.path.abspath(path): path for path in input_paths}.values())
+    if jobs is None or jobs < 1:
+        jobs = os.cpu_count() or 1
+    jobs = min(jobs, max(len(input_paths), 1))
+    if cv_threads is None:
+        cv_threads = max(1, (os.cpu_count() or 1) // jobs)
+    if estimation_workers is None:
+        # Same per-process core share as OpenCV gets
+        estimation_workers = cv_threads
+    if warp_workers is None:
+        warp_workers = cv_threads
+
+    names = output_names(input_paths)
+    for name in names:
+        os.makedirs(os.path.join(output_dir, os.path.dirname(name)), exist_ok=True)
+        if trace_dir:
+            os.makedirs(os.path.join(trace_dir, os.path.dirname(name)), exist_ok=True)
+
+    failures = 0
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_process, initargs=(cv_threads,)) as pool:
+        futures = {pool.submit(stabilize_file, path, os.path.join(output_dir, name), method, sigma,
+                               estimation_workers, estimation_scale, warp_workers, cache_dir, cache_max_bytes,
+                               os.path.join(trace_dir, name + ".trace.json") if trace_dir else None, crop,
+                               output_size, estimator, skip_interval): path
+                   for path, name in zip(input_paths, names)}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                n_frames, seconds = future.result()
+            except Exception as e:
+                failures += 1
+                print(f"FAILED {path}: {e}")
+                continue
+            fps = n_frames / seconds if seconds > 0 else float('inf')
+            print(f"OK {path}: {n_frames} frames in {seconds:.2f}s ({fps:.1f} frames/s)")
+
+    return failures
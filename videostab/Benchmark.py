@@ -0,0 +1,348 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2 as cv
+import numpy as np
+
+from videostab.Estimators import DEFAULT_ESTIMATOR, DEFAULT_SKIP_INTERVAL, ESTIMATORS
+from videostab.Instrumentation import Recorder
+from videostab.Stabilizer import Stabilizer
+from videostab.Trajectory import SMOOTHING_METHODS, decompose_cumulative
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEFAULT_SIZES = ((640, 360), (1280, 720), (1920, 1080))
+DEFAULT_LENGTHS = (120, 300)
+STAGES = ("decode", "prepare", "detect", "track", "estimate", "phase", "smooth", "warp", "encode")
+# Synthetic camera shake: the scene texture is this much larger than the frame on every side
+TEXTURE_MARGIN = 0.15
+# A stage (or the whole pipeline) more than this fraction slower than the baseline is a regression
+DEFAULT_TOLERANCE = 0.2
+# Trajectory error increases below this many pixels are noise, not regressions
+ERROR_NOISE_PX = 0.5
+
+
+# --- Synthetic videos ---
+
+def make_texture(width, height, rng):
+    """Scene larger than the frame: smooth colour noise plus random shapes, which give plenty of corners."""
+    coarse = rng.integers(0, 256, (height // 16 + 2, width // 16 + 2, 3), dtype=np.uint8)
+    texture = cv.resize(coarse, (width, height), interpolation=cv.INTER_CUBIC)
+    for _ in range(width * height // 3000):
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        size = int(rng.integers(4, max(5, min(width, height) // 20)))
+        if rng.random() < 0.5:
+            cv.rectangle(texture, (x, y), (x + size, y + size), color, -1)
+        else:
+            cv.circle(texture, (x, y), size // 2, color, -1)
+    return texture
+
+
+def camera_motion(n_frames, width, rng):
+    """Ground-truth camera positions (x, y, rotation) per frame: a slow pan plus hand shake."""
+    t = np.arange(n_frames)
+    max_shift = 0.6 * TEXTURE_MARGIN * width
+    pan = np.column_stack([0.5 * max_shift * np.sin(2 * np.pi * t / max(n_frames, 2)),
+                           0.25 * max_shift * np.sin(2 * np.pi * t / max(n_frames / 2, 2)),
+                           0.02 * np.sin(2 * np.pi * t / max(n_frames, 2))])
+    # Shake: noise low-passed over a couple of frames
+    shake = rng.normal(0, 1, (n_frames + 8, 3))
+    shake = np.array([shake[k:k + 9].mean(axis=0) for k in range(n_frames)])
+    shake *= np.array([0.02 * width, 0.02 * width, 0.005]) * 3
+    return np.clip(pan + shake, [-max_shift, -max_shift, -0.05], [max_shift, max_shift, 0.05])
+
+
+def scene_to_frame(position, texture_size, frame_size):
+    """3x3 matrix mapping texture coordinates into the frame of a camera at position (x, y, rotation)."""
+    x, y, r = position
+    (tw, th), (fw, fh) = texture_size, frame_size
+    cos_r, sin_r = np.cos(r), np.sin(r)
+    rotation = np.array([[cos_r, -sin_r, 0], [sin_r, cos_r, 0], [0, 0, 1]])
+    to_origin = np.array([[1, 0, -tw / 2 - x], [0, 1, -th / 2 - y], [0, 0, 1]])
+    to_frame = np.array([[1, 0, fw / 2], [0, 1, fh / 2], [0, 0, 1]])
+    return to_frame @ rotation @ to_origin
+
+
+def synthesize_video(path, width, height, n_frames, seed=0, fps=30):
+    """Writes a shaky video of a synthetic scene; returns the (N-1, 2, 3) ground-truth frame-to-frame transforms."""
+    rng = np.random.default_rng(seed)
+    texture_size = (int(width * (1 + 2 * TEXTURE_MARGIN)), int(height * (1 + 2 * TEXTURE_MARGIN)))
+    texture = make_texture(*texture_size, rng)
+    matrices = [scene_to_frame(position, texture_size, (width, height))
+                for position in camera_motion(n_frames, width, rng)]
+
+    writer = cv.VideoWriter(path, cv.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    if not writer.isOpened():
+        raise IOError(f"Could not open video writer for '{path}'")
+    try:
+        for matrix in matrices:
+            writer.write(cv.warpAffine(texture, matrix[:2], (width, height), flags=cv.INTER_LINEAR))
+    finally:
+        writer.release()
+
+    # Frame i -> frame i+1 is the scene -> frame mapping of i+1 after undoing that of i
+    return np.array([(matrices[i + 1] @ np.linalg.inv(matrices[i]))[:2] for i in range(n_frames - 1)])
+
+
+def prepare_case(work_dir, width, height, n_frames, seed):
+    """(video path, ground-truth transforms) of a case, generated once and reused from work_dir."""
+    name = case_name(width, height, n_frames)
+    video_path = os.path.join(work_dir, f"{name}-{seed}.mp4")
+    truth_path = os.path.join(work_dir, f"{name}-{seed}.npy")
+    if os.path.exists(video_path) and os.path.exists(truth_path):
+        return video_path, np.load(truth_path)
+    print(f"Generating {name}...")
+    truth = synthesize_video(video_path, width, height, n_frames, seed)
+    np.save(truth_path, truth)
+    return video_path, truth
+
+
+def case_name(width, height, n_frames):
+    return f"{width}x{height}x{n_frames}"
+
+
+# --- Measurements ---
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, or None where it can't be measured."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+def trajectory_error(transforms, truth):
+    """Errors of estimated frame-to-frame transforms against the ground truth, per path component."""
+    n = min(len(transforms), len(truth))
+    path = decompose_cumulative(transforms[:n])
+    true_path = decompose_cumulative(truth[:n])
+    pair = np.abs(np.diff(path, axis=0) - np.diff(true_path, axis=0))
+    drift = np.abs(path - true_path)
+    return {
+        "path_rmse_px": float(np.sqrt((drift[:, :2] ** 2).sum(axis=1).mean())),
+        "path_rmse_rad": float(np.sqrt((drift[:, 2] ** 2).mean())),
+        "final_drift_px": float(np.hypot(*drift[-1, :2])),
+        "pair_mae_px": float(np.hypot(pair[:, 0], pair[:, 1]).mean()),
+        "pair_mae_rad": float(pair[:, 2].mean()),
+    }
+
+
+def run_stages(video_path, method, sigma, estimator=DEFAULT_ESTIMATOR, skip_interval=DEFAULT_SKIP_INTERVAL):
+    """Instrumented Stabilizer run on one video, streaming as the CLI does but with one worker per stage.
+
+    The stages are timed by the recorder spans of the real code path. Both passes decode the video;
+    the decode stage is the motion pass's, the warp pass's decoding is kept as "decode (warp pass)".
+    Returns (Recorder, frame count)."""
+    recorder = Recorder(label=video_path)
+    fd, output_path = tempfile.mkstemp(suffix=".mp4")
+    os.close(fd)
+    try:
+        stabilizer = Stabilizer(None, method=method, sigma=sigma, video_path=video_path, output_path=output_path,
+                                estimation_workers=1, warp_workers=1, recorder=recorder, estimator=estimator,
+                                skip_interval=skip_interval)
+        n_frames = stabilizer.stabilize()
+    finally:
+        os.remove(output_path)
+
+    motion_end = max(start + duration for name, _, start, duration, _ in recorder.spans if name == "motion")
+    recorder.spans = [("decode (warp pass)",) + span[1:] if span[0] == "decode" and span[2] >= motion_end else span
+                      for span in recorder.spans]
+    return recorder, n_frames
+
+
+def run_pipeline(video_path, method, sigma, workers, estimator=DEFAULT_ESTIMATOR,
+                 skip_interval=DEFAULT_SKIP_INTERVAL):
+    """End-to-end Stabilizer run in streaming mode, as the CLI does. Returns (seconds, stabilizer)."""
+    fd, output_path = tempfile.mkstemp(suffix=".mp4")
+    os.close(fd)
+    try:
+        stabilizer = Stabilizer(None, method=method, sigma=sigma, video_path=video_path, output_path=output_path,
+                                estimation_workers=workers, warp_workers=workers, estimator=estimator,
+                                skip_interval=skip_interval)
+        start = time.perf_counter()
+        stabilizer.stabilize()
+        return time.perf_counter() - start, stabilizer
+    finally:
+        os.remove(output_path)
+
+
+def stage_report(recorder, n_frames):
+    spans = recorder.stats()["spans"]
+    report = {}
+    for name in STAGES:
+        seconds = spans[name]["total_ms"] / 1000 if name in spans else 0.0
+        report[name] = {
+            "seconds": round(seconds, 6),
+            "calls": spans[name]["count"] if name in spans else 0,
+            "ms_per_frame": round(1000 * seconds / n_frames, 4),
+            "fps": round(n_frames / seconds, 2) if seconds > 0 else None,
+        }
+    return report
+
+
+def run_case(video_path, truth, method, sigma, workers, estimator=DEFAULT_ESTIMATOR,
+             skip_interval=DEFAULT_SKIP_INTERVAL):
+    """Measures one case; run in its own process so the peak RSS belongs to this case alone."""
+    baseline_rss = peak_rss_mb()
+    recorder, n_frames = run_stages(video_path, method, sigma, estimator, skip_interval)
+    seconds, stabilizer = run_pipeline(video_path, method, sigma, workers, estimator, skip_interval)
+    pipeline_frames = len(stabilizer.path)
+    stages = stage_report(recorder, n_frames)
+    return {
+        "frames": n_frames,
+        "stages": stages,
+        "stage_total_seconds": round(sum(stage["seconds"] for stage in stages.values()), 6),
+        "counters": dict(recorder.counters),
+        "pipeline": {"seconds": round(seconds, 6), "fps": round(pipeline_frames / seconds, 2), "workers": workers},
+        "baseline_rss_mb": baseline_rss,
+        "peak_rss_mb": peak_rss_mb(),
+        "trajectory_error": trajectory_error(stabilizer.frame_transforms, truth),
+    }
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "opencv": cv.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, lengths=DEFAULT_LENGTHS, method="Gaussian", sigma=50, workers=1,
+                   work_dir=None, seed=0, estimator=DEFAULT_ESTIMATOR, skip_interval=DEFAULT_SKIP_INTERVAL):
+    """Generates (or reuses) every size x length case and measures it in a fresh process.
+
+    Returns the results as a JSON-serialisable dict."""
+    temporary = work_dir is None
+    if temporary:
+        work_dir = tempfile.mkdtemp(prefix="videostab-bench-")
+    os.makedirs(work_dir, exist_ok=True)
+
+    results = {"environment": environment(),
+               "settings": {"method": method, "sigma": sigma, "workers": workers, "seed": seed,
+                            "estimator": estimator, "skip_interval": skip_interval},
+               "cases": {}}
+    try:
+        for width, height in sizes:
+            for n_frames in lengths:
+                name = case_name(width, height, n_frames)
+                video_path, truth = prepare_case(work_dir, width, height, n_frames, seed)
+                # Spawned, so no memory of this process or of earlier cases counts towards the peak RSS
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                    case = pool.submit(run_case, video_path, truth, method, sigma, workers, estimator,
+                                       skip_interval).result()
+                case.update(width=width, height=height)
+                results["cases"][name] = case
+                print(f"{name}: pipeline {case['pipeline']['fps']:.1f} frames/s, "
+                      f"path RMSE {case['trajectory_error']['path_rmse_px']:.2f} px, "
+                      f"peak RSS {case['peak_rss_mb'] or 0:.0f} MB")
+    finally:
+        if temporary:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Regressions of results against a baseline results dict, as a list of messages."""
+    regressions = []
+    for name, case in results["cases"].items():
+        old = baseline.get("cases", {}).get(name)
+        if old is None:
+            continue
+        speeds = [("pipeline", case["pipeline"]["fps"], old["pipeline"]["fps"])]
+        speeds += [(stage, case["stages"][stage]["fps"], old["stages"].get(stage, {}).get("fps"))
+                   for stage in STAGES if stage in case["stages"]]
+        for stage, new_fps, old_fps in speeds:
+            if new_fps and old_fps and new_fps < old_fps * (1 - tolerance):
+                regressions.append(f"{name} {stage}: {new_fps:.1f} frames/s, was {old_fps:.1f}")
+
+        new_error = case["trajectory_error"]["path_rmse_px"]
+        old_error = old["trajectory_error"]["path_rmse_px"]
+        if new_error > old_error * (1 + tolerance) + ERROR_NOISE_PX:
+            regressions.append(f"{name} path RMSE: {new_error:.2f} px, was {old_error:.2f}")
+    return regressions
+
+
+def parse_sizes(text):
+    sizes = []
+    for size in text.split(","):
+        width, height = size.lower().split("x")
+        sizes.append((int(width), int(height)))
+    return sizes
+
+
+def parse_lengths(text):
+    return [int(length) for length in text.split(",")]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m videostab.Benchmark",
+                                     description="Benchmark the stabilizer on synthetic shaky videos with known motion.")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="Results JSON file (default: benchmark.json)")
+    parser.add_argument("--sizes", type=parse_sizes, default=DEFAULT_SIZES,
+                        help="Comma-separated frame sizes (default: 640x360,1280x720,1920x1080)")
+    parser.add_argument("--lengths", type=parse_lengths, default=DEFAULT_LENGTHS,
+                        help="Comma-separated frame counts (default: 120,300)")
+    parser.add_argument("--method", choices=SMOOTHING_METHODS, default="Gaussian",
+                        help="Smoothing method (default: Gaussian)")
+    parser.add_argument("--sigma", type=float, default=50, help="Smoothing factor (default: 50)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Estimation/warp threads of the end-to-end pipeline run (default: 1)")
+    parser.add_argument("--work-dir", default=None,
+                        help="Keep the generated videos here and reuse them on later runs (default: temporary)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic scenes and motion (default: 0)")
+    parser.add_argument("--estimator", choices=list(ESTIMATORS), default=DEFAULT_ESTIMATOR,
+                        help="Motion estimator (default: LK)")
+    parser.add_argument("--skip-interval", type=int, default=DEFAULT_SKIP_INTERVAL,
+                        help="Estimate low-motion stretches only every this many frames (default: 1, every frame)")
+    parser.add_argument("--compare", default=None, help="Baseline results JSON; exit with 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed slowdown against the baseline (default: 0.2 = 20%%)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run_benchmarks(args.sizes, args.lengths, args.method, args.sigma, args.workers,
+                             args.work_dir, args.seed, args.estimator, args.skip_interval)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for message in regressions:
+            print(f"REGRESSION {message}")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.compare}.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
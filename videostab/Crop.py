@@ -0,0 +1,123 @@
+import numpy as np
+from scipy.optimize import linprog
+
+# Crop modes: "Autocrop" zooms in on the largest window every stabilized frame covers, "None"
+# keeps the whole frame (with the black borders the corrections uncover)
+CROP_MODES = ("Autocrop", "None")
+# Autocrop never zooms in by more than 1 / this; beyond it the worst frames keep some border
+MIN_CROP_SCALE = 0.5
+# Distance (px) kept from the source edges, so bilinear sampling never reaches the black border
+EDGE_MARGIN = 1e-3
+# A window this close to the full frame is not worth a rescale of every frame
+FULL_FRAME_TOLERANCE = 1e-3
+
+
+def crop_extent(frame_size, output_size):
+    """(width, height) spans, in source pixel-centre units, of the largest window with the output's
+    aspect ratio that fits in the frame."""
+    width, height = frame_size
+    out_width, out_height = output_size
+    aspect = (out_width - 1) / max(out_height - 1, 1)
+    if (width - 1) / aspect <= height - 1:
+        return width - 1, (width - 1) / aspect
+    return (height - 1) * aspect, height - 1
+
+
+def centered_rect(frame_size, output_size, scale=1.0):
+    """(x0, y0, scale) of a window of the output's aspect ratio, centred in the frame."""
+    width, height = frame_size
+    span_w, span_h = crop_extent(frame_size, output_size)
+    return (width - 1 - scale * span_w) / 2, (height - 1 - scale * span_h) / 2, scale
+
+
+def autocrop_rect(transforms, frame_size, output_size=None, min_scale=MIN_CROP_SCALE):
+    """Largest axis-aligned window (of the output's aspect ratio) that is inside every warped frame.
+
+    transforms are the (N, 2, 3) corrections mapping source to stabilized pixels. The window is
+    [x0, x0 + scale * span_w] x [y0, y0 + scale * span_h] in stabilized coordinates (see crop_extent);
+    its corners mapped back through every inverse correction must land inside the source frame.
+    Those 16 constraints per frame are linear in (x0, y0, scale) and built for all frames at once.
+    Only a few frames bind, so the LP is solved over a growing subset of frames (starting from the
+    extreme ones) until no other frame is violated. Returns (x0, y0, scale)."""
+    width, height = frame_size
+    output_size = output_size or frame_size
+    transforms = np.asarray(transforms, dtype=np.float64)
+    span_w, span_h = crop_extent(frame_size, output_size)
+
+    # Inverse corrections: source = inv_linear @ stabilized + inv_offset
+    inv_linear = np.linalg.inv(transforms[:, :, :2])  # (N, 2, 2)
+    inv_offset = -np.einsum('nij,nj->ni', inv_linear, transforms[:, :, 2])  # (N, 2)
+
+    # Corner k of the window is (x0 + scale * ux_k * span_w, y0 + scale * uy_k * span_h)
+    ux = np.array([0, 1, 0, 1])
+    uy = np.array([0, 0, 1, 1])
+    # Coefficients of (x0, y0, scale) in source coordinate r of corner k of frame n: (N, 2, 4, 3)
+    coeffs = np.empty((len(transforms), 2, 4, 3))
+    coeffs[..., 0] = inv_linear[:, :, 0, None]
+    coeffs[..., 1] = inv_linear[:, :, 1, None]
+    coeffs[..., 2] = inv_linear[:, :, 0, None] * ux * span_w + inv_linear[:, :, 1, None] * uy * span_h
+    low = inv_offset[:, :, None] - EDGE_MARGIN
+    high = np.array([width - 1, height - 1])[:, None] - EDGE_MARGIN - inv_offset[:, :, None]
+    # EDGE_MARGIN <= source <= size - 1 - EDGE_MARGIN, as rows a . v <= b: (N, 16, 3) and (N, 16)
+    a_ub = np.concatenate([coeffs, -coeffs], axis=1).reshape(len(transforms), 16, 3)
+    b_ub = np.concatenate([np.broadcast_to(high, coeffs.shape[:3]), np.broadcast_to(low, coeffs.shape[:3])],
+                          axis=1).reshape(len(transforms), 16)
+
+    frames = np.unique(np.concatenate([inv_offset.argmin(axis=0), inv_offset.argmax(axis=0),
+                                       [inv_linear[:, 1, 0].argmin(), inv_linear[:, 1, 0].argmax()]]))
+    while True:
+        result = linprog([0, 0, -1], A_ub=a_ub[frames].reshape(-1, 3), b_ub=b_ub[frames].ravel(),
+                         bounds=[(None, None), (None, None), (0, 1)], method='highs')
+        if result.status != 0:
+            break
+        violation = (a_ub @ result.x - b_ub).max(axis=1)
+        violated = np.flatnonzero(violation > 1e-7)
+        if len(violated) == 0:
+            break
+        # The worst offenders first; the subset stays small
+        frames = np.union1d(frames, violated[np.argsort(violation[violated])[-64:]])
+
+    if result.status != 0 or result.x[2] < min_scale:
+        print(f"Warning: no crop window of at least {min_scale:.0%} of the frame fits every stabilized frame. "
+              f"Using a centred one; some frames keep a border.")
+        return centered_rect(frame_size, output_size, min_scale)
+    x0, y0, scale = result.x
+    if scale > 1 - FULL_FRAME_TOLERANCE:
+        # Nothing to crop (beyond the edge margin): keep the frame unscaled, whole-pixel shifts stay copies
+        return float(round(x0)), float(round(y0)), 1.0
+    return x0, y0, scale
+
+
+def apply_crop(transforms, rect, frame_size, output_size=None):
+    """Folds the crop window rect (x0, y0, scale) and its rescale to output_size into the corrections,
+    so each output frame is still a single resample: (N, 2, 3) float32."""
+    output_size = output_size or frame_size
+    x0, y0, scale = rect
+    span_w, span_h = crop_extent(frame_size, output_size)
+    zoom = np.array([(output_size[0] - 1) / (scale * span_w), (output_size[1] - 1) / (scale * span_h)])
+
+    transforms = np.asarray(transforms, dtype=np.float64)
+    cropped = np.empty(transforms.shape, dtype=np.float32)
+    cropped[:, :, :2] = zoom[None, :, None] * transforms[:, :, :2]
+    cropped[:, :, 2] = zoom * (transforms[:, :, 2] - np.array([x0, y0]))
+    return cropped
+
+
+def crop_corrections(transforms, frame_size, crop="Autocrop", output_size=None):
+    """Corrections with the crop mode applied, and the (width, height) of the frames they produce.
+
+    output_size defaults to frame_size; "None" only rescales (and centre-crops to the output's
+    aspect ratio) when a different output size is asked for."""
+    frame_size = tuple(frame_size)
+    output_size = tuple(output_size) if output_size else frame_size
+    if len(transforms) == 0:
+        return transforms, output_size
+    if crop == "Autocrop":
+        rect = autocrop_rect(transforms, frame_size, output_size)
+        print(f"Autocrop: keeping {rect[2]:.1%} of the frame at ({rect[0]:.1f}, {rect[1]:.1f}).")
+    elif output_size != frame_size:
+        rect = centered_rect(frame_size, output_size)
+    else:
+        return transforms, output_size
+    return apply_crop(transforms, rect, frame_size, output_size), output_size
+
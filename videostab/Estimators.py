@@ -0,0 +1,454 @@
+import cv2 as cv
+import numpy as np
+
+from videostab.Instrumentation import NULL_RECORDER
+from videostab.Trajectory import IDENTITY_AFFINE
+
+# Params for ShiTomasi corner detection
+FEATURE_PARAMS = dict(maxCorners=200, qualityLevel=0.1, minDistance=30, blockSize=3)
+# Parameters for lucas kanade optical flow
+LK_PARAMS = dict(winSize=(20, 20), maxLevel=3,
+                 criteria=(cv.TERM_CRITERIA_EPS | cv.TERM_CRITERIA_COUNT, 10, 0.03))
+# RANSAC reprojection threshold for estimateAffinePartial2D
+RANSAC_REPROJ_THRESHOLD = 5.0
+
+# Feature tracking: carried points are topped up by re-detection when fewer than this survive,
+# only in the cells of this grid that lost coverage
+REDETECT_MIN_POINTS = 100
+REDETECT_GRID = (4, 4)
+
+# Auto estimation scale: motion is estimated on luma no larger than this on its longest side (~1080p)
+ESTIMATION_MAX_SIDE = 1920
+
+# Phase correlation runs on luma no larger than this on its longest side
+PHASE_MAX_SIDE = 320
+# Correlation peaks weaker than this (rotation, blur, low texture, independent foreground motion)
+# are not trusted by the Hybrid estimator, which then falls back to LK. On textured footage a pure
+# shift peaks above 0.9, a 1 degree rotation around 0.9, 2 degrees around 0.6 and 4 degrees below 0.2
+PHASE_MIN_RESPONSE = 0.5
+
+# Frame skipping: pairs whose approximate motion (source pixels) is below this are low-motion, and
+# below the second one near-duplicates (repeated frames of variable-frame-rate sources)
+SKIP_MAX_MOTION = 0.5
+DUPLICATE_MAX_MOTION = 0.02
+# Longest side of the thumbnails that motion is approximated on
+SKIP_THUMBNAIL_SIDE = 128
+# Full estimation of every pair (no skipping)
+DEFAULT_SKIP_INTERVAL = 1
+
+
+def auto_estimation_scale(width, height, max_side=ESTIMATION_MAX_SIDE):
+    """Downscale factor that brings the longest side down to max_side (never upscales)."""
+    return min(1.0, max_side / max(width, height, 1))
+
+
+def to_estimation_gray(frame, scale=1.0):
+    """Luma image used for motion estimation, downscaled by scale.
+
+    The colour frame is shrunk first so cvtColor only runs on the small image."""
+    if scale < 1.0:
+        frame = cv.resize(frame, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+    return cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+
+
+def pyramid_input_supported():
+    """Whether these OpenCV bindings accept prebuilt pyramids in calcOpticalFlowPyrLK.
+
+    Checked once on a tiny image; some Python builds only take plain images."""
+    global _pyramid_input_supported
+    if _pyramid_input_supported is None:
+        image = np.zeros((64, 64), np.uint8)
+        _, pyramid = cv.buildOpticalFlowPyramid(image, LK_PARAMS['winSize'], LK_PARAMS['maxLevel'])
+        try:
+            cv.calcOpticalFlowPyrLK(pyramid, pyramid, np.zeros((1, 1, 2), np.float32), None, **LK_PARAMS)
+            _pyramid_input_supported = True
+        except (cv.error, TypeError):
+            _pyramid_input_supported = False
+    return _pyramid_input_supported
+
+
+_pyramid_input_supported = None
+
+
+class EstimationFrame:
+    """Per-frame precomputation for motion estimation, built once and shared by detection and flow.
+
+    gray is the estimation luma image; flow_input is its LK pyramid (with derivatives) when the
+    bindings accept pyramids, otherwise gray itself."""
+
+    def __init__(self, gray):
+        self.gray = gray
+        if pyramid_input_supported():
+            _, self.flow_input = cv.buildOpticalFlowPyramid(gray, LK_PARAMS['winSize'], LK_PARAMS['maxLevel'])
+        else:
+            self.flow_input = gray
+
+
+def prepare_estimation_frame(frame, scale=1.0):
+    return EstimationFrame(to_estimation_gray(frame, scale))
+
+
+def rescale_transform(transform, scale):
+    """Maps a transform estimated on images downscaled by scale back to source resolution.
+
+    For a similarity transform only the translation changes (S^-1 @ A @ S with S = diag(s, s, 1))."""
+    if scale == 1.0:
+        return transform
+    transform = transform.copy()
+    transform[:2, 2] /= scale
+    return transform
+
+def estimate_transform(good_old, good_new, i):
+    """RANSAC similarity estimate between matched points.
+
+    Returns (2x3 float32 transform, inlier mask or None); identity when estimation fails."""
+    if len(good_new) >= 4 and len(good_old) >= 4:
+        try:
+            # Use estimateAffine2D as before
+            affine_matrix, mask = cv.estimateAffinePartial2D(good_old, good_new, method=cv.RANSAC,
+                                                             ransacReprojThreshold=RANSAC_REPROJ_THRESHOLD)
+
+            if affine_matrix is not None:
+                return affine_matrix.astype(np.float32), mask
+            print(f"Warning: estimateAffinePartial2D failed at frame {i}. Using identity.")
+
+        except cv.error as e:
+            print(f"Error estimating transform at frame {i}: {e}. Using identity.")
+    else:
+        print(
+            f"Warning: Not enough good points ({len(good_new)}) found for transform estimation at frame {i}. Using identity.")
+
+    return IDENTITY_AFFINE.copy(), None
+
+
+class FeatureTracker:
+    """Carries good feature points from frame to frame instead of re-detecting corners on every pair.
+
+    Shi-Tomasi detection only runs when fewer than min_points survive, and then only in the grid
+    cells that lost coverage. LK starts from the points' old positions: on shaky footage consecutive
+    motions are unrelated, and seeding it with the previous pair's motion locked it onto wrong matches.
+    Points are in the (possibly downscaled) estimation image coordinates.
+    With a recorder, detection, LK tracking and RANSAC are timed per pair and the feature, point,
+    inlier and identity fallback counts are recorded."""
+
+    def __init__(self, scale=1.0, min_points=REDETECT_MIN_POINTS, grid=REDETECT_GRID, recorder=NULL_RECORDER):
+        self.scale = scale
+        self.min_points = min_points
+        self.grid = grid
+        self.points = None  # Points located in the last new frame, shape (N, 1, 2)
+        self.inside = None  # Which of the last tracked points are still inside the frame
+        self.recorder = recorder
+        self.pair = None  # Index of the pair being estimated, for the recorder
+
+    def reset(self):
+        self.points = None
+
+    def detect(self, gray):
+        """Tops up self.points with fresh corners in under-covered grid cells of gray."""
+        max_new = FEATURE_PARAMS['maxCorners']
+        mask = None
+        if self.points is not None and len(self.points) > 0:
+            h, w = gray.shape[:2]
+            rows, cols = self.grid
+            cell_h, cell_w = -(-h // rows), -(-w // cols)
+            pts = self.points.reshape(-1, 2)
+            cell_y = np.clip(pts[:, 1] // cell_h, 0, rows - 1).astype(int)
+            cell_x = np.clip(pts[:, 0] // cell_w, 0, cols - 1).astype(int)
+            counts = np.bincount(cell_y * cols + cell_x, minlength=rows * cols).reshape(rows, cols)
+
+            sparse = counts < max(1, self.min_points // (rows * cols))
+            if not sparse.any():
+                return
+            cell_mask = np.where(sparse, 255, 0).astype(np.uint8)
+            mask = np.repeat(np.repeat(cell_mask, cell_h, axis=0), cell_w, axis=1)[:h, :w]
+            max_new = max(1, max_new - len(self.points))
+
+        params = dict(FEATURE_PARAMS, maxCorners=max_new)
+        with self.recorder.span("detect", self.pair):
+            new_points = cv.goodFeaturesToTrack(gray, mask=mask, **params)
+        if new_points is None:
+            return
+        self.recorder.count("features_detected", len(new_points), self.pair)
+        if mask is None:
+            self.points = new_points
+        else:
+            self.points = np.vstack([self.points, new_points]).astype(np.float32)
+
+    def track(self, old, new):
+        """Tracks the carried points from EstimationFrame old into new.
+
+        Returns (good_old, good_new), or (None, None) when there are too few features to track."""
+        if self.points is None or len(self.points) < self.min_points:
+            self.detect(old.gray)
+
+        p0 = self.points
+        if p0 is None or len(p0) < 10:  # Need sufficient points
+            self.reset()
+            return None, None
+
+        with self.recorder.span("track", self.pair):
+            p1, st, err = cv.calcOpticalFlowPyrLK(old.flow_input, new.flow_input, p0, None, **LK_PARAMS)
+
+        # Select good points
+        if p1 is not None and st is not None:
+            good = st.ravel() == 1
+            good_new = p1[good].reshape(-1, 2)
+            good_old = p0[good].reshape(-1, 2)
+        else:
+            good_new, good_old = np.empty((0, 2), np.float32), np.empty((0, 2), np.float32)
+        self.recorder.count("points_tracked", len(good_new), self.pair)
+
+        # Points that left the frame can't be tracked any further
+        h, w = new.gray.shape[:2]
+        inside = ((good_new[:, 0] >= 0) & (good_new[:, 0] < w) & (good_new[:, 1] >= 0) & (good_new[:, 1] < h))
+        self.inside = inside
+        self.points = good_new[inside].reshape(-1, 1, 2)
+        return good_old, good_new
+
+    def keep(self, good_new, inliers):
+        """Restricts the carried points to the RANSAC inliers."""
+        keep = self.inside & (inliers.ravel() == 1)
+        self.points = good_new[keep].reshape(-1, 1, 2).astype(np.float32)
+
+    def estimate(self, old, new, i):
+        """Transform from EstimationFrame old to new (pair index i, used for logging), in source resolution."""
+        self.pair = i
+        good_old, good_new = self.track(old, new)
+        if good_old is None:
+            print(f"Warning: Not enough features found at frame {i}. Using identity transform.")
+            self.record_fallback(i, "not enough features")
+            return IDENTITY_AFFINE.copy()
+
+        with self.recorder.span("estimate", i):
+            transform, inliers = estimate_transform(good_old, good_new, i)
+        if inliers is not None:
+            self.recorder.count("ransac_inliers", int(inliers.sum()), i)
+            self.keep(good_new, inliers)
+        else:
+            self.record_fallback(i, "estimation failed")
+        return rescale_transform(transform, self.scale)
+
+    def record_fallback(self, i, reason):
+        self.recorder.count("identity_fallbacks", 1, i)
+        self.recorder.event("identity_fallback", i, reason=reason)
+
+    def prepare(self, frame):
+        return prepare_estimation_frame(frame, self.scale)
+
+
+class PhaseFrame:
+    """Float luma downscaled by scale and windowed (image, the input of cv.phaseCorrelate), and the
+    plain luma it was made from."""
+
+    def __init__(self, image, scale, gray):
+        self.image = image
+        self.scale = scale
+        self.gray = gray
+
+
+class PhaseCorrelator:
+    """Translation-only motion from cv.phaseCorrelate on luma downscaled to PHASE_MAX_SIDE.
+
+    No features, no optical flow and no RANSAC: one FFT-based correlation per pair, so it is much
+    faster than LK but blind to rotation. The peak response (0..1) is its confidence."""
+
+    def __init__(self, scale=1.0, recorder=NULL_RECORDER, max_side=PHASE_MAX_SIDE):
+        self.scale = scale
+        self.recorder = recorder
+        self.max_side = max_side
+        self.window = None  # Hanning window against edge effects, built for the first frame size
+
+    def reset(self):
+        pass  # Stateless between pairs
+
+    def prepare_luma(self, gray, width, height):
+        """PhaseFrame from the luma (at any resolution) of a width x height frame."""
+        phase_scale = min(1.0, self.max_side / max(width, height, 1))
+        size = (max(1, round(width * phase_scale)), max(1, round(height * phase_scale)))
+        if (gray.shape[1], gray.shape[0]) != size:
+            gray = cv.resize(gray, size, interpolation=cv.INTER_AREA)
+        if self.window is None or self.window.shape != gray.shape:
+            self.window = cv.createHanningWindow(size, cv.CV_32F)
+        # Windowed once here: phaseCorrelate would apply its window in place, again on every pair
+        return PhaseFrame(np.float32(gray) * self.window, phase_scale, gray)
+
+    def prepare(self, frame):
+        # Converting to luma first makes the downscale a single-channel one
+        height, width = frame.shape[:2]
+        return self.prepare_luma(cv.cvtColor(frame, cv.COLOR_BGR2GRAY), width, height)
+
+    def correlate(self, old, new, i):
+        """(transform, peak response) from PhaseFrame old to new."""
+        with self.recorder.span("phase", i):
+            (dx, dy), response = cv.phaseCorrelate(old.image, new.image)
+        transform = IDENTITY_AFFINE.copy()
+        transform[0, 2] = dx / old.scale
+        transform[1, 2] = dy / old.scale
+        return transform, response
+
+    def estimate(self, old, new, i):
+        return self.correlate(old, new, i)[0]
+
+
+class HybridFrame:
+    """A PhaseFrame plus the estimation luma; the LK pyramid is only built if a pair needs it."""
+
+    def __init__(self, phase, gray):
+        self.phase = phase
+        self.gray = gray
+        self.estimation_frame = None
+
+    @property
+    def lk(self):
+        if self.estimation_frame is None:
+            self.estimation_frame = EstimationFrame(self.gray)
+        return self.estimation_frame
+
+
+class HybridEstimator:
+    """Phase correlation first; pairs whose correlation peak is below min_response are re-estimated
+    by the LK/RANSAC tracker. Fast on plain shake, and still handles rotation and hard pairs."""
+
+    def __init__(self, scale=1.0, recorder=NULL_RECORDER, min_response=PHASE_MIN_RESPONSE):
+        self.scale = scale
+        self.recorder = recorder
+        self.min_response = min_response
+        self.phase = PhaseCorrelator(scale, recorder)
+        self.tracker = FeatureTracker(scale, recorder=recorder)
+        self.tracked = None  # Last pair the tracker estimated
+
+    def reset(self):
+        self.tracker.reset()
+
+    def prepare(self, frame):
+        gray = to_estimation_gray(frame, self.scale)
+        height, width = frame.shape[:2]
+        # The phase image is shrunk from the estimation luma, not from the colour frame again
+        return HybridFrame(self.phase.prepare_luma(gray, width, height), gray)
+
+    def estimate(self, old, new, i):
+        transform, response = self.phase.correlate(old.phase, new.phase, i)
+        if response >= self.min_response:
+            return transform
+        self.recorder.count("lk_fallbacks", 1, i)
+        if self.tracked != i - 1:
+            self.tracker.reset()  # Its carried points belong to an earlier frame
+        self.tracked = i
+        return self.tracker.estimate(old.lk, new.lk, i)
+
+
+# Motion estimator backends by name. An estimator is constructed as cls(scale, recorder=recorder);
+# prepare(frame) builds a frame's precomputed form (which keeps its luma as .gray), estimate(old, new, i)
+# returns the 2x3 transform between two prepared frames in source resolution, and reset() drops the
+# state carried between pairs.
+ESTIMATORS = {"LK": FeatureTracker, "Phase": PhaseCorrelator, "Hybrid": HybridEstimator}
+DEFAULT_ESTIMATOR = "LK"
+
+
+def make_estimator(name=DEFAULT_ESTIMATOR, scale=1.0, recorder=NULL_RECORDER):
+    if name not in ESTIMATORS:
+        raise ValueError(f"Unknown motion estimator '{name}' (choose from {', '.join(ESTIMATORS)})")
+    return ESTIMATORS[name](scale, recorder=recorder)
+
+
+def interpolate_transform(transform, n):
+    """The 2x3 similarity step that, taken n times, adds up to transform in the (dx, dy, dr) camera path."""
+    angle = np.arctan2(transform[1, 0], transform[0, 0]) / n
+    zoom = np.hypot(transform[0, 0], transform[1, 0]) ** (1 / n)
+    step = np.empty_like(transform)
+    step[:, :2] = zoom * np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    step[:, 2] = transform[:, 2] / n
+    return step
+
+
+def thumbnail(gray, size):
+    """gray shrunk to size (width, height): halved with INTER_LINEAR (an exact 2x2 mean) while it
+    can be, then INTER_AREA, which is slow for large non-integer ratios."""
+    while gray.shape[1] >= 2 * size[0] and gray.shape[0] >= 2 * size[1]:
+        gray = cv.resize(gray, (gray.shape[1] // 2, gray.shape[0] // 2), interpolation=cv.INTER_LINEAR)
+    return cv.resize(gray, size, interpolation=cv.INTER_AREA)
+
+
+class GatedFrame:
+    """A prepared frame plus the thumbnail its motion to the neighbouring frames is approximated on."""
+
+    def __init__(self, prepared, thumbnail, gradient, scale):
+        self.prepared = prepared
+        self.thumbnail = thumbnail
+        self.gradient = gradient  # Mean absolute thumbnail gradient (grey levels per thumbnail pixel)
+        self.scale = scale  # Thumbnail size / source size
+
+
+class FrameSkipper:
+    """Adaptive frame skipping around an estimator, for footage with long static stretches.
+
+    A pair's motion is approximated from its thumbnails (mean absolute difference over mean gradient,
+    in source pixels). Near-duplicate pairs get the identity. A run of low-motion pairs is estimated
+    once, from its first to its last frame, every interval pairs (or when motion picks up), and the
+    result is spread evenly over the run's pairs. Other pairs are estimated as usual.
+
+    push(old, new, i) therefore returns the transforms settled so far, possibly none or several;
+    flush() settles the pending run and must be called at the end of the pairs and before reset().
+    With interval 1 every pair is estimated and frames are prepared as by the estimator alone."""
+
+    def __init__(self, estimator, interval=DEFAULT_SKIP_INTERVAL, recorder=NULL_RECORDER):
+        self.estimator = estimator
+        self.interval = interval
+        self.recorder = recorder
+        self.run = []  # Motion of each pair of the pending low-motion run
+        self.run_start = None  # GatedFrame the run starts at
+        self.run_end = None  # GatedFrame the run ends at
+        self.first = 0  # Pair index the run starts at
+
+    def reset(self):
+        self.run = []
+        self.estimator.reset()
+
+    def prepare(self, frame):
+        prepared = self.estimator.prepare(frame)
+        if self.interval <= 1:
+            return prepared
+        height, width = frame.shape[:2]
+        scale = SKIP_THUMBNAIL_SIDE / max(width, height, 1)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        small = np.float32(thumbnail(prepared.gray, size))
+        gradient = (np.abs(np.diff(small, axis=0)).mean() + np.abs(np.diff(small, axis=1)).mean()) / 2
+        return GatedFrame(prepared, small, gradient, scale)
+
+    def motion(self, old, new):
+        """Approximate motion in source pixels (brightness constancy: difference ~ gradient x shift)."""
+        difference = cv.norm(old.thumbnail, new.thumbnail, cv.NORM_L1) / old.thumbnail.size
+        return float(difference / max(old.gradient, 1e-6) / old.scale)
+
+    def push(self, old, new, i):
+        if self.interval <= 1:
+            return [self.estimator.estimate(old, new, i)]
+        motion = self.motion(old, new)
+        if motion > SKIP_MAX_MOTION:
+            settled = self.flush()
+            settled.append(self.estimator.estimate(old.prepared, new.prepared, i))
+            return settled
+        if not self.run:
+            self.run_start, self.first = old, i
+        self.run.append(motion)
+        self.run_end = new
+        if len(self.run) >= self.interval:
+            return self.flush()
+        return []
+
+    def flush(self):
+        run, self.run = self.run, []
+        if not run:
+            return []
+        moving = [motion > DUPLICATE_MAX_MOTION for motion in run]
+        n_moving = sum(moving)
+        last = self.first + len(run) - 1
+        if n_moving < len(run):
+            self.recorder.count("duplicate_pairs", len(run) - n_moving, last)
+        if n_moving == 0:
+            return [IDENTITY_AFFINE.copy() for _ in run]
+        transform = self.estimator.estimate(self.run_start.prepared, self.run_end.prepared, last)
+        if n_moving > 1:
+            self.recorder.count("skipped_pairs", n_moving - 1, last)
+        step = interpolate_transform(transform, n_moving)
+        return [step.copy() if is_moving else IDENTITY_AFFINE.copy() for is_moving in moving]
@@ -0,0 +1,70 @@
+import os
+
+import cv2 as cv
+
+import Utils
+from videostab.Pipeline import warp_encode
+
+# Codecs offered for export; availability depends on the OpenCV build (mp4v always works with .mp4)
+FOURCCS = ("mp4v", "avc1", "XVID", "MJPG")
+DEFAULT_FOURCC = "mp4v"
+
+
+def open_writer(path, width, height, fps, fourcc=DEFAULT_FOURCC):
+    writer = cv.VideoWriter(path, cv.VideoWriter_fourcc(*fourcc), fps, (width, height))
+    if not writer.isOpened():
+        raise IOError(f"Could not open video writer for '{path}' with codec {fourcc}")
+    return writer
+
+
+def remove_partial(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def export_stabilized(video_path, transforms, output_path, fourcc=DEFAULT_FOURCC, fps=None, workers=1,
+                      progress=None, cancel=None, size=None):
+    """Re-decodes video_path, warps frame i by transforms[i] and encodes the result to output_path.
+
+    Frames stream through the decode -> warp -> encode pipeline, so nothing is materialized.
+    fps and size (width, height) default to the source's. progress is an optional callable(done, total);
+    cancel an optional threading.Event that stops the export between frames, in which case the
+    partial file is removed. Returns the number of frames written."""
+    _, source_fps, width, height = Utils.get_video_properties(video_path)
+    width, height = size or (width, height)
+    writer = open_writer(output_path, width, height, fps or source_fps, fourcc)
+    try:
+        written = warp_encode(video_path, writer, transforms, workers, progress=progress, cancel=cancel,
+                              size=(width, height))
+    finally:
+        writer.release()
+    if cancel is not None and cancel.is_set():
+        remove_partial(output_path)
+    return written
+
+
+def export_frames(frames, output_path, fps, fourcc=DEFAULT_FOURCC, progress=None, cancel=None):
+    """Encodes a sequence of frames (e.g. a FrameStore or lazy StabilizedFrames) to output_path, one at a time.
+
+    Same progress / cancel behaviour as export_stabilized. Returns the number of frames written."""
+    total = len(frames)
+    if total == 0:
+        return 0
+    height, width = frames[0].shape[:2]
+    writer = open_writer(output_path, width, height, fps, fourcc)
+    written = 0
+    try:
+        for frame in frames:
+            if cancel is not None and cancel.is_set():
+                break
+            writer.write(frame)
+            written += 1
+            if progress is not None:
+                progress(written, total)
+    finally:
+        writer.release()
+    if cancel is not None and cancel.is_set():
+        remove_partial(output_path)
+    return written
@@ -0,0 +1,184 @@
+import threading
+from collections import OrderedDict
+
+import cv2 as cv
+
+DEFAULT_CACHE_BYTES = 512 << 20  # 512 MiB of decoded frames
+PREFETCH_FRAMES = 8
+# Requests up to this many frames ahead of the decoder are reached by decoding forward,
+# which is cheaper than a seek (the backend seeks to the previous keyframe and decodes forward anyway)
+FORWARD_DECODE_LIMIT = 30
+
+
+class FrameSource:
+    """Random-access frames of a video file, decoded on demand instead of loaded up front.
+
+    Opening only reads the container's frame count and rate and decodes the first frame, so it is
+    instant whatever the video length. No frame/timestamp index is built: frames are assumed to be
+    at a constant rate, which is exact for constant-frame-rate video only. source[i] is served from
+    a memory-bounded LRU cache; misses set the capture's frame position (OpenCV converts it to a
+    timestamp at the container's rate and decodes forward from the keyframe before it) or, for
+    short hops ahead, keep decoding forward. On variable-frame-rate video such seeks can land a few
+    frames off. After every access a background thread prefetches a few frames in the playback
+    direction. Iterating (or iter_from) decodes sequentially with its own capture."""
+
+    # Random access means decoding, so estimators should consume this source sequentially
+    random_access = False
+
+    def __init__(self, path, cache_bytes=DEFAULT_CACHE_BYTES, prefetch=PREFETCH_FRAMES):
+        self.path = path
+        self.capture = cv.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise IOError(f"Could not open video '{path}'")
+
+        # The container's frame count is a hint; it is corrected when decoding hits the real end
+        self.frame_count = int(self.capture.get(cv.CAP_PROP_FRAME_COUNT))
+        self.fps = self.capture.get(cv.CAP_PROP_FPS) or 30
+
+        ret, first_frame = self.capture.read()
+        if not ret:
+            self.capture.release()
+            raise ValueError("No frames could be loaded from the selected file.")
+        self.frame_count = max(self.frame_count, 1)
+        self.shape = first_frame.shape
+        self.position = 1  # Index of the frame the capture decodes next
+
+        self.capacity = max(2 * prefetch + 2, cache_bytes // first_frame.nbytes)
+        self.cache = OrderedDict([(0, first_frame)])
+        self.lock = threading.RLock()
+
+        self.prefetch = prefetch
+        self.last_index = 0
+        self.direction = 1
+        self.generation = 0  # Bumped on every request so a stale prefetch stops early
+        self.prefetch_wanted = threading.Event()
+        self.closed = False
+        self.prefetch_thread = threading.Thread(target=self.prefetch_loop, name="prefetch", daemon=True)
+        self.prefetch_thread.start()
+
+    def __len__(self):
+        return self.frame_count
+
+    def timestamp(self, index):
+        """Presentation time of frame index, in seconds, assuming a constant frame rate."""
+        return index / self.fps
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+
+        with self.lock:
+            self.generation += 1
+            frame = self.cache.get(index)
+            if frame is not None:
+                self.cache.move_to_end(index)
+            else:
+                frame = self.decode(index)
+
+            if index != self.last_index:
+                self.direction = 1 if index > self.last_index else -1
+            self.last_index = index
+
+        self.prefetch_wanted.set()
+        return frame
+
+    def __iter__(self):
+        return self.iter_from(0)
+
+    def iter_from(self, start):
+        """Yields frames start, start+1, ... decoded sequentially by a capture of its own (bypassing the cache)."""
+        capture = cv.VideoCapture(self.path)
+        if not capture.isOpened():
+            raise IOError(f"Could not open video '{self.path}'")
+        if start:
+            capture.set(cv.CAP_PROP_POS_FRAMES, start)
+        count = start
+        try:
+            while True:
+                ret, frame = capture.read()
+                if not ret:
+                    break
+                count += 1
+                yield frame
+        finally:
+            capture.release()
+        with self.lock:
+            self.frame_count = count  # Now known exactly
+
+    def decode(self, index):
+        """Decodes up to frame index, caching every frame on the way. Caller holds the lock."""
+        if not self.position <= index < self.position + FORWARD_DECODE_LIMIT:
+            self.capture.set(cv.CAP_PROP_POS_FRAMES, index)
+            self.position = index
+
+        frame = None
+        while self.position <= index:
+            ret, frame = self.capture.read()
+            if not ret:
+                # Fewer frames than the container claimed
+                self.truncate(self.position)
+                raise IndexError(index)
+            self.store(self.position, frame)
+            self.position += 1
+        return frame
+
+    def truncate(self, missing):
+        """Shrinks the source to the frames that actually decode, given that frame missing doesn't.
+
+        Bisects between the last frame known to decode and missing. Caller holds the lock."""
+        known = max((i for i in self.cache if i < missing), default=0)
+        while missing - known > 1:
+            middle = (known + missing) // 2
+            self.capture.set(cv.CAP_PROP_POS_FRAMES, middle)
+            ret, frame = self.capture.read()
+            if ret:
+                self.store(middle, frame)
+                known = middle
+            else:
+                missing = middle
+        if known + 1 < self.frame_count:
+            print(f"Warning: '{self.path}' has {known + 1} frames, not the {self.frame_count} its container claims.")
+        self.frame_count = known + 1
+        self.position = self.frame_count  # The capture's position is unknown: the next decode seeks
+
+    def store(self, index, frame):
+        self.cache[index] = frame
+        self.cache.move_to_end(index)
+        while len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
+
+    def prefetch_loop(self):
+        while True:
+            self.prefetch_wanted.wait()
+            self.prefetch_wanted.clear()
+            if self.closed:
+                return
+
+            with self.lock:
+                generation = self.generation
+                if self.direction > 0:
+                    targets = range(self.last_index + 1, min(self.last_index + 1 + self.prefetch, len(self)))
+                else:
+                    # One seek to the start of the window, then forward decoding fills it
+                    targets = range(max(0, self.last_index - self.prefetch), self.last_index)
+
+            for target in targets:
+                with self.lock:
+                    if self.closed or generation != self.generation:
+                        break  # A newer request decides what to prefetch
+                    if target in self.cache:
+                        continue
+                    try:
+                        self.decode(target)
+                    except (IndexError, cv.error):
+                        break
+
+    def close(self):
+        self.closed = True
+        self.prefetch_wanted.set()
+        self.prefetch_thread.join()
+        with self.lock:
+            self.capture.release()
+            self.cache.clear()
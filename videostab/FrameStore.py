@@ -0,0 +1,238 @@
+import multiprocessing
+import os
+import tempfile
+import weakref
+from multiprocessing import resource_tracker, shared_memory
+
+import cv2 as cv
+import numpy as np
+
+DEFAULT_RAM_BUDGET = 2 << 30  # 2 GiB; bigger stores spill to a memory-mapped file
+
+
+def shared_memory_available():
+    """Free bytes of the shared memory filesystem (often small in containers), or unlimited if unknown.
+
+    Linux backs shared memory with /dev/shm and only fails when pages are touched, so the RAM
+    store must not be allocated past what is free there."""
+    try:
+        stat = os.statvfs("/dev/shm")
+    except (OSError, AttributeError):
+        return float("inf")
+    return stat.f_bavail * stat.f_frsize
+
+
+class SharedSegment(shared_memory.SharedMemory):
+    """SharedMemory that can be closed while frames still view it: the mapping then goes away
+    with the last of them instead of close() failing."""
+
+    def close(self):
+        try:
+            super().close()
+        except BufferError:
+            pass
+
+
+def shared_memory_array(shm, shape, dtype):
+    # frombuffer holds a buffer export on the mapping, so it can't be unmapped under a live frame
+    return np.frombuffer(shm.buf, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def release_buffer(shm, spill_path, owner_pid):
+    """Unmaps a store's buffer, and frees it when called in the process that created it."""
+    owner = owner_pid == os.getpid()  # Forked children inherit stores but must not free them
+    if shm is not None:
+        shm.close()
+        if owner:
+            shm.unlink()
+    if spill_path is not None and owner:
+        try:
+            os.remove(spill_path)
+        except OSError:
+            pass
+
+
+class FrameStore:
+    """Frames held in one contiguous (N, H, W, C) buffer instead of a list of separate arrays.
+
+    Up to ram_budget bytes the buffer lives in shared memory; above it, in a numpy.memmap spill
+    file on local disk (spill_dir, the temp directory by default). Either way other processes can
+    attach without copying: pickling a store sends only its descriptor (shared memory name or
+    spill file path), and unpickling attaches to the same buffer. Only the creating store frees
+    the buffer, on close(), when garbage collected or at exit.
+
+    Indexing, len() and iteration work like a list of frames; store.frames is the (N, H, W, C)
+    array of the frames appended so far."""
+
+    def __init__(self, capacity, frame_shape, dtype=np.uint8, ram_budget=DEFAULT_RAM_BUDGET, spill_dir=None):
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        self.ram_budget = ram_budget
+        self.spill_dir = spill_dir
+        self.count = 0
+        self.owner_pid = os.getpid()
+        self.shm = None
+        self.spill_path = None
+        self.buffer = None
+        self.finalizer = None
+        self.allocate(max(1, capacity))
+
+    @classmethod
+    def from_frames(cls, frames, ram_budget=DEFAULT_RAM_BUDGET, spill_dir=None):
+        """Store copied from a sequence of equally sized frames."""
+        store = None
+        for frame in frames:
+            if store is None:
+                capacity = len(frames) if hasattr(frames, '__len__') else 1
+                store = cls(capacity, frame.shape, frame.dtype, ram_budget, spill_dir)
+            store.append(frame)
+        if store is not None:
+            store.trim()
+        return store
+
+    @classmethod
+    def from_video(cls, path, ram_budget=DEFAULT_RAM_BUDGET, spill_dir=None):
+        """Decodes path straight into a store sized from the container's frame count. None if no frame decodes."""
+        capture = cv.VideoCapture(path)
+        if not capture.isOpened():
+            raise IOError(f"Could not open video '{path}'")
+        try:
+            ret, first_frame = capture.read()
+            if not ret:
+                return None
+            capacity = int(capture.get(cv.CAP_PROP_FRAME_COUNT))
+            store = cls(capacity, first_frame.shape, first_frame.dtype, ram_budget, spill_dir)
+            store.append(first_frame)
+            while True:
+                if store.count == store.capacity:
+                    # More frames than the container claimed (or exactly as many)
+                    ret, frame = capture.read()
+                    if not ret:
+                        break
+                    store.append(frame)
+                    continue
+                slot = store.buffer[store.count]
+                ret, image = capture.read(slot)  # Decode in place
+                if not ret:
+                    break
+                if not np.shares_memory(image, slot):
+                    raise ValueError(f"Frame {store.count} has a different size than the first frame.")
+                store.count += 1
+        finally:
+            capture.release()
+        store.trim()
+        return store
+
+    def allocate(self, capacity):
+        """Points self.buffer at a fresh buffer for capacity frames, moving the current frames into it."""
+        old_buffer, old_finalizer = self.buffer, self.finalizer
+        shape = (capacity,) + self.frame_shape
+        nbytes = int(np.prod(shape)) * self.dtype.itemsize
+
+        if nbytes <= min(self.ram_budget, shared_memory_available()):
+            self.shm = SharedSegment(create=True, size=max(1, nbytes))
+            self.spill_path = None
+            buffer = shared_memory_array(self.shm, shape, self.dtype)
+        else:
+            fd, self.spill_path = tempfile.mkstemp(suffix=".frames", dir=self.spill_dir)
+            os.close(fd)
+            self.shm = None
+            buffer = np.memmap(self.spill_path, dtype=self.dtype, mode="w+", shape=shape)
+
+        if old_buffer is not None:
+            buffer[:self.count] = old_buffer[:self.count]
+        self.buffer = buffer
+        self.capacity = capacity
+        self.finalizer = weakref.finalize(self, release_buffer, self.shm, self.spill_path, self.owner_pid)
+        if old_finalizer is not None:
+            del old_buffer
+            old_finalizer()
+
+    def grow(self):
+        self.allocate(self.capacity * 2)
+
+    def trim(self):
+        """Shrinks the buffer to the frames actually appended (e.g. when the container count was off)."""
+        if 0 < self.count < self.capacity:
+            self.allocate(self.count)
+
+    def append(self, frame):
+        if frame.shape != self.frame_shape:
+            raise ValueError(f"Frame {self.count} has a different size than the first frame.")
+        if self.count == self.capacity:
+            self.grow()
+        self.buffer[self.count] = frame
+        self.count += 1
+
+    @property
+    def frames(self):
+        return self.buffer[:self.count]
+
+    @property
+    def nbytes(self):
+        return self.frames.nbytes
+
+    def is_spilled(self):
+        return self.spill_path is not None
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.frames[index]
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    # --- Process handoff ---
+
+    def descriptor(self):
+        """Picklable description of the buffer that another process can attach() to."""
+        return {
+            "shm_name": self.shm.name if self.shm is not None else None,
+            "spill_path": self.spill_path,
+            "capacity": self.capacity,
+            "count": self.count,
+            "frame_shape": self.frame_shape,
+            "dtype": self.dtype.str,
+        }
+
+    @classmethod
+    def attach(cls, descriptor):
+        """Store viewing the buffer of another process's store, without copying or owning it."""
+        store = cls.__new__(cls)
+        store.frame_shape = tuple(descriptor["frame_shape"])
+        store.dtype = np.dtype(descriptor["dtype"])
+        store.ram_budget = DEFAULT_RAM_BUDGET
+        store.spill_dir = None
+        store.count = descriptor["count"]
+        store.capacity = descriptor["capacity"]
+        store.owner_pid = None
+        store.spill_path = descriptor["spill_path"]
+        shape = (store.capacity,) + store.frame_shape
+        if descriptor["shm_name"] is not None:
+            store.shm = SharedSegment(name=descriptor["shm_name"])
+            if multiprocessing.parent_process() is None:
+                # Attaching registered the segment with this process's own resource tracker, which
+                # would unlink it when this process exits; the creating store is responsible for that.
+                # (multiprocessing children share the creator's tracker, so they leave it alone.)
+                resource_tracker.unregister(store.shm._name, "shared_memory")
+            store.buffer = shared_memory_array(store.shm, shape, store.dtype)
+        else:
+            store.shm = None
+            store.buffer = np.memmap(store.spill_path, dtype=store.dtype, mode="r+", shape=shape)
+        store.finalizer = weakref.finalize(store, release_buffer, store.shm, None, None)
+        return store
+
+    def __reduce__(self):
+        return FrameStore.attach, (self.descriptor(),)
+
+    def owns_buffer(self):
+        return self.owner_pid == os.getpid()
+
+    def close(self):
+        """Frees the buffer (unlinks the shared memory / deletes the spill file when owned)."""
+        self.buffer = None
+        self.shm = None
+        if self.finalizer is not None:
+            self.finalizer()
@@ -0,0 +1,181 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+# Frames listed by name in the summary (slowest frames, identity fallbacks)
+SUMMARY_FRAMES = 10
+
+
+class Span:
+    """Times one with-block into its recorder."""
+    __slots__ = ("recorder", "name", "frame", "start")
+
+    def __init__(self, recorder, name, frame):
+        self.recorder = recorder
+        self.name = name
+        self.frame = frame
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter()
+        # list.append is atomic, spans may close on any thread
+        self.recorder.spans.append((self.name, self.recorder.thread_id(), self.start, end - self.start, self.frame))
+        return False
+
+
+class Recorder:
+    """Opt-in instrumentation of a stabilization run: timed spans per stage and per frame, counters and events.
+
+    Pass one to Stabilizer(recorder=...). Spans with a frame index are per-frame work (decode,
+    detect, track, ...), the others whole stages. Counters (features detected, points tracked,
+    RANSAC inliers, identity fallbacks) are totalled and sampled per frame. Safe to use from
+    several threads. Export with write_trace() (Chrome trace / Perfetto JSON) or summary()."""
+
+    enabled = True
+
+    def __init__(self, label=None):
+        self.label = label
+        self.origin = time.perf_counter()
+        self.spans = []  # (name, thread id, start, duration, frame or None)
+        self.samples = []  # (counter name, time, frame or None, value)
+        self.events = []  # (name, thread id, time, frame or None, args)
+        self.counters = defaultdict(int)
+        self.lock = threading.Lock()
+        self.thread_names = {}  # Pipeline threads may be gone by the time the trace is written
+
+    def thread_id(self):
+        tid = threading.get_ident()
+        if tid not in self.thread_names:
+            self.thread_names[tid] = threading.current_thread().name
+        return tid
+
+    def span(self, name, frame=None):
+        return Span(self, name, frame)
+
+    def count(self, name, value=1, frame=None):
+        with self.lock:
+            self.counters[name] += value
+        self.samples.append((name, time.perf_counter(), frame, value))
+
+    def event(self, name, frame=None, **args):
+        self.events.append((name, self.thread_id(), time.perf_counter(), frame, args))
+
+    # --- Export ---
+
+    def stats(self):
+        """Per-span-name timing statistics, counter totals and the frames with events, as a dict."""
+        durations = defaultdict(list)
+        for name, _, _, duration, _ in self.spans:
+            durations[name].append(duration)
+        spans = {}
+        for name, values in durations.items():
+            values = np.array(values) * 1000
+            spans[name] = {"count": len(values), "total_ms": float(values.sum()), "mean_ms": float(values.mean()),
+                           "p95_ms": float(np.percentile(values, 95)), "max_ms": float(values.max())}
+
+        event_frames = defaultdict(list)
+        for name, _, _, frame, _ in self.events:
+            if frame is not None:
+                event_frames[name].append(frame)
+        return {"label": self.label, "spans": spans, "counters": dict(self.counters),
+                "event_frames": {name: sorted(frames) for name, frames in event_frames.items()}}
+
+    def frame_times(self):
+        """Total span time per frame index, in seconds."""
+        times = defaultdict(float)
+        for _, _, _, duration, frame in self.spans:
+            if frame is not None:
+                times[frame] += duration
+        return times
+
+    def summary(self):
+        """Human-readable summary: stage timings, counters, slowest frames and identity fallbacks."""
+        stats = self.stats()
+        lines = [f"Instrumentation summary{f' for {self.label}' if self.label else ''}:"]
+        for name, s in sorted(stats["spans"].items(), key=lambda item: -item[1]["total_ms"]):
+            lines.append(f"  {name:<12} {s['count']:>7} x  total {s['total_ms']:10.1f} ms  mean {s['mean_ms']:8.3f} ms"
+                         f"  p95 {s['p95_ms']:8.3f} ms  max {s['max_ms']:8.3f} ms")
+        for name, total in sorted(stats["counters"].items()):
+            lines.append(f"  {name:<20} {total}")
+
+        slowest = sorted(self.frame_times().items(), key=lambda item: -item[1])[:SUMMARY_FRAMES]
+        if slowest:
+            lines.append("  slowest frames: " + ", ".join(f"{frame} ({seconds * 1000:.1f} ms)"
+                                                          for frame, seconds in slowest))
+        for name, frames in sorted(stats["event_frames"].items()):
+            shown = ", ".join(str(frame) for frame in frames[:SUMMARY_FRAMES])
+            more = f" and {len(frames) - SUMMARY_FRAMES} more" if len(frames) > SUMMARY_FRAMES else ""
+            lines.append(f"  {name} at frames: {shown}{more}")
+        return "\n".join(lines)
+
+    def trace_events(self):
+        """Chrome trace event list (load in chrome://tracing or ui.perfetto.dev); times in microseconds."""
+        pid = os.getpid()
+
+        def us(t):
+            return (t - self.origin) * 1e6
+
+        events = []
+        thread_ids = set()
+        for name, tid, start, duration, frame in self.spans:
+            thread_ids.add(tid)
+            event = {"name": name, "cat": "stage" if frame is None else "frame", "ph": "X", "pid": pid, "tid": tid,
+                     "ts": us(start), "dur": duration * 1e6}
+            if frame is not None:
+                event["args"] = {"frame": frame}
+            events.append(event)
+        for name, tid, t, frame, args in self.events:
+            thread_ids.add(tid)
+            events.append({"name": name, "cat": "event", "ph": "i", "s": "t", "pid": pid, "tid": tid, "ts": us(t),
+                           "args": dict(args, frame=frame)})
+
+        # Counters as running totals, so the trace shows how they grow over the run
+        totals = defaultdict(int)
+        for name, t, _, value in sorted(self.samples, key=lambda sample: sample[1]):
+            totals[name] += value
+            events.append({"name": name, "ph": "C", "pid": pid, "ts": us(t), "args": {name: totals[name]}})
+
+        for tid in thread_ids:
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                           "args": {"name": self.thread_names.get(tid, f"thread {tid}")}})
+        return events
+
+    def write_trace(self, path):
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.trace_events(), "displayTimeUnit": "ms", "otherData": self.stats()}, f)
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class NullRecorder:
+    """Recorder that records nothing: the default, so instrumented code costs a no-op call per span."""
+
+    enabled = False
+    span_instance = NullSpan()
+
+    def span(self, name, frame=None):
+        return self.span_instance
+
+    def count(self, name, value=1, frame=None):
+        pass
+
+    def event(self, name, frame=None, **args):
+        pass
+
+
+NULL_RECORDER = NullRecorder()
@@ -0,0 +1,277 @@
+import argparse
+import contextlib
+import sys
+import time
+from collections import deque
+
+import cv2 as cv
+import numpy as np
+
+from videostab.Estimators import DEFAULT_ESTIMATOR, ESTIMATORS, auto_estimation_scale, make_estimator
+from videostab.Stabilizer import TRACK_SEGMENT_PAIRS
+from videostab.Trajectory import decompose_cumulative, path_corrections
+from videostab.Warp import warp_frame
+
+# Frames held back so the smoother can see this far into the future (0 = purely causal)
+DEFAULT_LOOKAHEAD = 15
+DEFAULT_SIGMA = 15
+# Seconds between the running latency/throughput reports
+REPORT_INTERVAL = 5.0
+
+
+class LatencyStats:
+    """End-to-end latency (frame read from the source -> stabilized frame out) and sustained throughput."""
+
+    def __init__(self):
+        self.latencies = []
+        self.first_arrival = None
+        self.last_output = None
+
+    def record(self, arrival):
+        now = time.perf_counter()
+        if self.first_arrival is None:
+            self.first_arrival = arrival
+        self.last_output = now
+        self.latencies.append(now - arrival)
+
+    def fps(self):
+        if not self.latencies or self.last_output <= self.first_arrival:
+            return 0.0
+        return len(self.latencies) / (self.last_output - self.first_arrival)
+
+    def summary(self):
+        if not self.latencies:
+            return "0 frames"
+        latencies_ms = np.array(self.latencies) * 1000
+        return (f"{len(latencies_ms)} frames, {self.fps():.1f} frames/s sustained, latency "
+                f"mean {latencies_ms.mean():.1f} ms, p95 {np.percentile(latencies_ms, 95):.1f} ms, "
+                f"max {latencies_ms.max():.1f} ms")
+
+
+class OnlineStabilizer:
+    """Causal stabilization of a frame stream with a fixed look-ahead, for live or piped input.
+
+    The offline smoother filters the whole path, so nothing can be output before the last frame
+    is read. Here each frame's motion is estimated as it arrives, and a frame is released once
+    `lookahead` newer frames are known: its smoothed position is a Gaussian (sigma) average of
+    the path over the 3 sigma frames before it and the look-ahead after it. Latency is bounded by
+    the look-ahead plus the per-frame processing time.
+
+    push(frame) returns the stabilized frame leaving the window (None while it fills); flush()
+    returns the frames still held at the end of the stream."""
+
+    def __init__(self, lookahead=DEFAULT_LOOKAHEAD, sigma=DEFAULT_SIGMA, estimation_scale=None,
+                 estimator=DEFAULT_ESTIMATOR):
+        if not sigma > 0:
+            raise ValueError(f"sigma must be positive, got {sigma}")
+        if lookahead < 0:
+            raise ValueError(f"lookahead must not be negative, got {lookahead}")
+        self.lookahead = int(lookahead)
+        self.history = max(1, int(round(3 * sigma)))
+        offsets = np.arange(-self.history, self.lookahead + 1)
+        self.kernel = np.exp(-0.5 * (offsets / sigma) ** 2)
+        self.estimation_scale = estimation_scale
+        self.estimator = estimator
+
+        self.tracker = None
+        self.previous = None  # Prepared form of the newest frame
+        self.position = np.zeros(3)  # Cumulative (dx, dy, dr) of the newest frame
+        self.path = deque(maxlen=self.history + self.lookahead + 1)  # Positions of the newest frames
+        self.pending = deque()  # (index, frame, arrival time) waiting for their look-ahead
+        self.frames_in = 0
+        self.stats = LatencyStats()
+
+    def push(self, frame, arrival=None):
+        """Feeds the next frame. arrival is when it was read (perf_counter), for the latency stats."""
+        if arrival is None:
+            arrival = time.perf_counter()
+        self.track(frame)
+        self.pending.append((self.frames_in, frame, arrival))
+        self.frames_in += 1
+        if len(self.pending) > self.lookahead:
+            return self.emit()
+        return None
+
+    def flush(self):
+        return [self.emit() for _ in range(len(self.pending))]
+
+    def track(self, frame):
+        if self.tracker is None:
+            scale = self.estimation_scale
+            if scale is None:
+                scale = auto_estimation_scale(frame.shape[1], frame.shape[0])
+            self.tracker = make_estimator(self.estimator, scale)
+
+        new = self.tracker.prepare(frame)
+        if self.previous is not None:
+            i = self.frames_in - 1  # Pair index, tracker segments line up with the offline estimator
+            if i % TRACK_SEGMENT_PAIRS == 0:
+                self.tracker.reset()
+            transform = self.tracker.estimate(self.previous, new, i)
+            self.position = self.position + decompose_cumulative(transform[None])[1]
+        self.path.append(self.position)
+        self.previous = new
+
+    def emit(self):
+        index, frame, arrival = self.pending.popleft()
+
+        # Smooth over the known positions within the kernel, renormalised at the stream edges
+        path = np.array(self.path)
+        first = self.frames_in - len(path)
+        offsets = np.arange(first, self.frames_in) - index
+        usable = (offsets >= -self.history) & (offsets <= self.lookahead)
+        weights = self.kernel[offsets[usable] + self.history]
+        smoothed = weights @ path[usable] / weights.sum()
+
+        correction = path_corrections(path[index - first][None], smoothed[None])[0]
+        stabilized = warp_frame(frame, correction, index)
+        self.stats.record(arrival)
+        return stabilized
+
+
+def iter_capture(capture):
+    try:
+        while True:
+            ret, frame = capture.read()
+            if not ret:
+                break
+            yield frame
+    finally:
+        capture.release()
+
+
+def iter_raw_frames(stream, width, height):
+    """Yields bgr24 frames of width x height read from a binary stream (e.g. ffmpeg -f rawvideo -pix_fmt bgr24 -)."""
+    while True:
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        view = memoryview(frame).cast("B")
+        filled = 0
+        while filled < len(view):
+            n = stream.readinto(view[filled:])
+            if not n:
+                return  # End of stream (a trailing partial frame is dropped)
+            filled += n
+        yield frame
+
+
+def open_live_source(source, frame_size=None):
+    """(frame iterator, fps or None) for a camera index ("0"), a raw frame pipe ("-") or a file/URL."""
+    if source == "-":
+        if frame_size is None:
+            raise ValueError("Raw frames on stdin need a frame size (--size WIDTHxHEIGHT).")
+        return iter_raw_frames(sys.stdin.buffer, *frame_size), None
+
+    capture = cv.VideoCapture(int(source) if source.isdigit() else source)
+    if not capture.isOpened():
+        raise IOError(f"Could not open video source '{source}'")
+    fps = capture.get(cv.CAP_PROP_FPS)
+    return iter_capture(capture), fps if fps and fps > 0 else None
+
+
+class LiveSink:
+    """Writes stabilized frames as raw bgr24 to stdout ("-"), to a video file, or nowhere (None)."""
+
+    def __init__(self, output, fps):
+        self.output = output
+        self.fps = fps
+        self.writer = None
+        self.stream = sys.stdout.buffer if output == "-" else None
+
+    def write(self, frame):
+        if self.output is None:
+            return
+        if self.output == "-":
+            self.stream.write(np.ascontiguousarray(frame).data)
+            return
+        if self.writer is None:
+            height, width = frame.shape[:2]
+            self.writer = cv.VideoWriter(self.output, cv.VideoWriter_fourcc(*'mp4v'), self.fps, (width, height))
+            if not self.writer.isOpened():
+                raise IOError(f"Could not open video writer for '{self.output}'")
+        self.writer.write(frame)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+        elif self.stream is not None:
+            self.stream.flush()
+
+
+def run_online(source, output=None, lookahead=DEFAULT_LOOKAHEAD, sigma=DEFAULT_SIGMA, estimation_scale=None,
+               frame_size=None, fps=None, report_interval=REPORT_INTERVAL, estimator=DEFAULT_ESTIMATOR):
+    """Stabilizes a live source frame by frame, printing running latency/throughput reports.
+
+    Returns the OnlineStabilizer, whose stats hold the measured latency and throughput."""
+    frames, source_fps = open_live_source(source, frame_size)
+    stabilizer = OnlineStabilizer(lookahead, sigma, estimation_scale, estimator)
+    sink = LiveSink(output, fps or source_fps or 30)
+    next_report = time.perf_counter() + report_interval
+
+    # Messages go to stderr, stdout may be carrying the frames
+    with contextlib.redirect_stdout(sys.stderr):
+        try:
+            for frame in frames:
+                stabilized = stabilizer.push(frame, time.perf_counter())
+                if stabilized is not None:
+                    sink.write(stabilized)
+                if report_interval and time.perf_counter() >= next_report:
+                    print(stabilizer.stats.summary())
+                    next_report += report_interval
+            for stabilized in stabilizer.flush():
+                sink.write(stabilized)
+        finally:
+            sink.close()
+
+        print(f"Online stabilization: {stabilizer.stats.summary()}")
+    return stabilizer
+
+
+def parse_frame_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def positive_float(text):
+    value = float(text)
+    if not value > 0:
+        raise argparse.ArgumentTypeError(f"must be positive, got {text}")
+    return value
+
+
+def non_negative_int(text):
+    value = int(text)
+    if value < 0:
+        raise argparse.ArgumentTypeError(f"must not be negative, got {text}")
+    return value
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m videostab.Online",
+                                     description="Low-latency stabilization of a live or piped video stream.")
+    parser.add_argument("source", help="Camera index (e.g. 0), '-' for raw bgr24 frames on stdin, or a file/URL")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Output video file, or '-' for raw bgr24 frames on stdout (default: discard)")
+    parser.add_argument("--lookahead", type=non_negative_int, default=DEFAULT_LOOKAHEAD,
+                        help="Frames of look-ahead for the smoother, i.e. added latency (default: 15)")
+    parser.add_argument("--sigma", type=positive_float, default=DEFAULT_SIGMA, help="Smoothing factor (default: 15)")
+    parser.add_argument("--size", type=parse_frame_size, default=None,
+                        help="Frame size WIDTHxHEIGHT of raw stdin frames")
+    parser.add_argument("--fps", type=float, default=None,
+                        help="Output frame rate (default: the source's, or 30)")
+    parser.add_argument("--estimation-scale", type=float, default=None,
+                        help="Downscale factor for motion estimation (default: automatic, ~1080p)")
+    parser.add_argument("--estimator", choices=list(ESTIMATORS), default=DEFAULT_ESTIMATOR,
+                        help="Motion estimator (default: LK)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    run_online(args.source, args.output, lookahead=args.lookahead, sigma=args.sigma,
+               estimation_scale=args.estimation_scale, frame_size=args.size, fps=args.fps,
+               estimator=args.estimator)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,228 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2 as cv
+import numpy as np
+
+from videostab.Instrumentation import NULL_RECORDER
+from videostab.Warp import warp_frame
+
+# Capacity of the bounded queues between stages; a full queue blocks the producing stage
+QUEUE_DEPTH = 8
+# Marks the end of a stage's output
+END = object()
+
+
+class FrameRing:
+    """Fixed set of reusable frame arrays handed out by slot index.
+
+    acquire() blocks while every slot is in use, which is what applies backpressure
+    to the stage producing into the ring."""
+
+    def __init__(self, n_slots, shape, dtype=np.uint8):
+        self.slots = np.empty((n_slots,) + tuple(shape), dtype=dtype)
+        self.free = queue.Queue()
+        for slot in range(n_slots):
+            self.free.put(slot)
+
+    def acquire(self, stop):
+        """Next free slot, or None once stop is set."""
+        while not stop.is_set():
+            try:
+                return self.free.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def release(self, slot):
+        self.free.put(slot)
+
+
+class StageThread(threading.Thread):
+    """Runs one pipeline stage; an exception stops the whole pipeline and is re-raised by the caller."""
+
+    def __init__(self, name, target, stop):
+        super().__init__(name=name, daemon=True)
+        self.target = target
+        self.stop = stop
+        self.error = None
+
+    def run(self):
+        try:
+            self.target()
+        except BaseException as e:
+            self.error = e
+            self.stop.set()
+
+
+def put(q, item, stop):
+    """Blocking put that gives up once stop is set."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def get(q, stop):
+    """Blocking get that returns END once stop is set."""
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return END
+
+
+def open_capture(path, start=0):
+    """Opens path at frame start and decodes that frame, which fixes the ring buffer frame shape."""
+    capture = cv.VideoCapture(path)
+    if not capture.isOpened():
+        raise IOError(f"Could not open video '{path}'")
+    if start:
+        capture.set(cv.CAP_PROP_POS_FRAMES, start)
+    ret, first_frame = capture.read()
+    if not ret:
+        capture.release()
+        raise ValueError(f"No frames could be decoded from '{path}' at frame {start}")
+    return capture, first_frame
+
+
+def decode_stage(capture, first_frame, ring, output, stop, max_frames=None, recorder=NULL_RECORDER):
+    """Decodes frames straight into ring slots and queues (index, slot) pairs, then END."""
+
+    def decode():
+        index = 0
+        frame = first_frame
+        while not stop.is_set() and (max_frames is None or index < max_frames):
+            slot = ring.acquire(stop)
+            if slot is None:
+                return
+            if frame is not None:
+                ring.slots[slot] = frame
+                frame = None
+            else:
+                with recorder.span("decode", index):
+                    ret, image = capture.read(ring.slots[slot])
+                if not ret:
+                    ring.release(slot)
+                    break
+                if not np.shares_memory(image, ring.slots[slot]):
+                    raise ValueError(f"Frame {index} has a different size than the first frame.")
+            if not put(output, (index, slot), stop):
+                return
+            index += 1
+        put(output, END, stop)
+
+    return decode
+
+
+def finish(stop, threads):
+    stop.set()
+    for thread in threads:
+        thread.join()
+    for thread in threads:
+        if thread.error is not None:
+            raise thread.error
+
+
+def iter_decoded(path, depth=QUEUE_DEPTH, recorder=NULL_RECORDER, start=0, max_frames=None):
+    """Yields the frames of path (max_frames of them from frame start, by default all), decoded
+    ahead by a background thread into a ring of reused arrays.
+
+    A yielded frame is only valid until the next one is requested (its slot is then recycled)."""
+    capture, first_frame = open_capture(path, start)
+    stop = threading.Event()
+    ring = FrameRing(depth + 2, first_frame.shape, first_frame.dtype)
+    decoded = queue.Queue(maxsize=depth)
+    decoder = StageThread("decode", decode_stage(capture, first_frame, ring, decoded, stop, max_frames, recorder),
+                          stop)
+    decoder.start()
+
+    try:
+        while True:
+            item = get(decoded, stop)
+            if item is END:
+                break
+            _, slot = item
+            yield ring.slots[slot]
+            ring.release(slot)
+    finally:
+        finish(stop, [decoder])
+        capture.release()
+
+
+def warp_encode(path, writer, transforms, workers=1, depth=QUEUE_DEPTH, progress=None, recorder=NULL_RECORDER,
+                cancel=None, size=None, start=0):
+    """Decode -> warp -> encode as concurrent stages connected by bounded queues.
+
+    A decode thread fills a ring of input frames, the calling thread dispatches warps to a pool of
+    workers (each writing into a slot of an output ring) in frame order, and an encode thread
+    writes the finished frames to writer in that same order. Decode and encode overlap with the
+    warps, and memory is bounded by the two rings whatever the video length.
+    progress is an optional callable(done, total), called from the encode thread. Setting the
+    optional threading.Event cancel stops dispatching new frames; the ones in flight are still written.
+    size is the output (width, height) the writer expects, by default the source frame size.
+    Decoding begins at frame start, which transforms[0] applies to.
+
+    Returns the number of frames written."""
+    n_frames = len(transforms)
+    capture, first_frame = open_capture(path, start)
+    stop = threading.Event()
+    in_ring = FrameRing(depth + 2, first_frame.shape, first_frame.dtype)
+    out_shape = first_frame.shape if size is None else (size[1], size[0]) + first_frame.shape[2:]
+    out_ring = FrameRing(depth + 2, out_shape, first_frame.dtype)
+    decoded = queue.Queue(maxsize=depth)
+    to_encode = queue.Queue(maxsize=depth)
+    written = [0]
+
+    def encode():
+        while True:
+            item = get(to_encode, stop)
+            if item is END:
+                return
+            future, in_slot, out_slot = item
+            future.result()
+            in_ring.release(in_slot)
+            with recorder.span("encode", written[0]):
+                writer.write(out_ring.slots[out_slot])
+            out_ring.release(out_slot)
+            written[0] += 1
+            if progress is not None:
+                progress(written[0], n_frames)
+
+    def warp(i, in_slot, out_slot):
+        with recorder.span("warp", i):
+            warp_frame(in_ring.slots[in_slot], transforms[i], i, out_ring.slots[out_slot])
+
+    decoder = StageThread("decode", decode_stage(capture, first_frame, in_ring, decoded, stop, n_frames, recorder),
+                          stop)
+    encoder = StageThread("encode", encode, stop)
+    decoder.start()
+    encoder.start()
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            while True:
+                item = get(decoded, stop)
+                if item is END:
+                    break
+                i, in_slot = item
+                if cancel is not None and cancel.is_set():
+                    break
+                out_slot = out_ring.acquire(stop)
+                if out_slot is None:
+                    break
+                future = pool.submit(warp, i, in_slot, out_slot)
+                if not put(to_encode, (future, in_slot, out_slot), stop):
+                    break
+            put(to_encode, END, stop)
+            encoder.join()
+    finally:
+        finish(stop, [decoder, encoder])
+        capture.release()
+
+    return written[0]
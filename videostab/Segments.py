@@ -0,0 +1,396 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2 as cv
+import numpy as np
+
+import Utils
+from videostab.Batch import init_process
+from videostab.Crop import CROP_MODES, crop_corrections
+from videostab.Estimators import DEFAULT_ESTIMATOR, DEFAULT_SKIP_INTERVAL, ESTIMATORS
+from videostab.Export import DEFAULT_FOURCC, open_writer
+from videostab.Online import parse_frame_size
+from videostab.Pipeline import iter_decoded, warp_encode
+from videostab.Stabilizer import TRACK_SEGMENT_PAIRS, Stabilizer
+from videostab.Trajectory import SMOOTHING_METHODS, decompose_cumulative, smooth_corrections
+
+# Segment length and overlap in frames, rounded up to whole tracker segments so each segment's
+# transforms match what a single run would estimate (the tracker restarts at the same frames)
+DEFAULT_SEGMENT_FRAMES = 3000
+DEFAULT_OVERLAP = TRACK_SEGMENT_PAIRS
+# Seconds between checks of the job directory while waiting for other workers
+POLL_INTERVAL = 0.5
+
+JOB_FILE = "job.json"
+SMOOTH_FILE = "smooth.npz"
+# Marks the output as complete (a file at the output path may be left over from an earlier run)
+DONE_FILE = "done"
+
+
+def round_up(frames):
+    return -(-frames // TRACK_SEGMENT_PAIRS) * TRACK_SEGMENT_PAIRS
+
+
+def plan_segments(n_frames, segment_frames=DEFAULT_SEGMENT_FRAMES, overlap=DEFAULT_OVERLAP):
+    """Overlapping [start, end) frame ranges covering n_frames; the last one is open (end None), since
+    the container's frame count is only a hint."""
+    overlap = round_up(max(overlap, 1))
+    segment_frames = max(round_up(segment_frames), overlap + TRACK_SEGMENT_PAIRS)
+    segments = []
+    start = 0
+    while start + segment_frames < n_frames:
+        segments.append([start, start + segment_frames])
+        start += segment_frames - overlap
+    segments.append([start, None])
+    return segments
+
+
+def stitch_paths(segments, segment_transforms):
+    """One global (N, 3) path from per-segment frame transforms.
+
+    Each segment's transforms are decomposed into a local path starting at 0; it is offset onto the
+    global path by their mean difference over the overlap, and the two are cross-faded there so a
+    segment boundary leaves no step."""
+    path = None
+    for (start, _), transforms in zip(segments, segment_transforms):
+        local = decompose_cumulative(transforms)
+        if path is None:
+            path = local
+            continue
+        overlap = len(path) - start
+        if overlap < 1 or len(transforms) == 0:
+            raise ValueError(f"Segment at frame {start} does not overlap the previous one.")
+        offset = (path[start:] - local[:overlap]).mean(axis=0)
+        weight = np.linspace(1, 0, overlap)[:, None]
+        path[start:] = weight * path[start:] + (1 - weight) * (local[:overlap] + offset)
+        path = np.concatenate([path, local[overlap:] + offset])
+    return path
+
+
+def owned_ranges(segments, n_frames):
+    """Non-overlapping [start, end) ranges, one per segment, that each warp task writes."""
+    starts = [start for start, _ in segments] + [n_frames]
+    return [(starts[k], starts[k + 1]) for k in range(len(segments)) if starts[k] < starts[k + 1]]
+
+
+def concat_command(list_path, output_path):
+    """ffmpeg concat demuxer: joins the segment files by copying their packets, no re-encode."""
+    return ["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path,
+            "-c", "copy", output_path]
+
+
+def can_concat():
+    return shutil.which("ffmpeg") is not None
+
+
+def prepare_job(video_path, output_path, job_dir, segment_frames=DEFAULT_SEGMENT_FRAMES, overlap=DEFAULT_OVERLAP,
+                method="Gaussian", sigma=50, crop="Autocrop", output_size=None, estimation_scale=None,
+                fourcc=DEFAULT_FOURCC, estimator=DEFAULT_ESTIMATOR, skip_interval=DEFAULT_SKIP_INTERVAL):
+    """Writes job.json to job_dir (which every worker must be able to reach, as well as the video). Returns the job.
+
+    Results in job_dir count as done work, so a non-empty job_dir is only accepted when it holds this
+    same job (input, output and settings), which then resumes; anything else raises ValueError."""
+    n_frames, fps, width, height = Utils.get_video_properties(video_path)
+    job = dict(video=os.path.abspath(video_path), output=os.path.abspath(output_path), fps=fps,
+               frame_size=[width, height], segments=plan_segments(n_frames, segment_frames, overlap),
+               method=method, sigma=sigma, crop=crop, output_size=output_size, estimation_scale=estimation_scale,
+               fourcc=fourcc, estimator=estimator, skip_interval=skip_interval)
+    # As it reads back from job.json
+    job = json.loads(json.dumps(job))
+    os.makedirs(job_dir, exist_ok=True)
+    if os.listdir(job_dir):
+        try:
+            with open(os.path.join(job_dir, JOB_FILE)) as f:
+                existing = json.load(f)
+        except (OSError, ValueError):
+            existing = None
+        if existing != job:
+            raise ValueError(f"Job directory '{job_dir}' is not empty and holds a different job; "
+                             f"use an empty directory, or the same input, output and settings to resume it.")
+        print(f"Resuming the job in {job_dir}.")
+        return job
+    write_atomic(os.path.join(job_dir, JOB_FILE), lambda f: f.write(json.dumps(job, indent=2).encode()))
+    print(f"Planned {len(job['segments'])} segments of {video_path} in {job_dir}.")
+    return job
+
+
+def temporary_path(path):
+    """Private name next to path, keeping the extension (it selects the video container)."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.{socket.gethostname()}-{os.getpid()}.tmp{ext}"
+
+
+def write_atomic(path, write):
+    """Other workers only ever see complete results: written to a temporary name, then renamed."""
+    tmp_path = temporary_path(path)
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def claim(job_dir, task):
+    """Takes task for this worker; O_EXCL creation makes this atomic across processes and hosts."""
+    try:
+        fd = os.open(os.path.join(job_dir, task + ".claim"), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w") as f:
+        f.write(f"{socket.gethostname()} {os.getpid()}\n")
+    return True
+
+
+def run_task(job_dir, task, result_path, function):
+    """Runs function(result_path) if task is unclaimed and not done. A failure is recorded for the others."""
+    if os.path.exists(result_path) or not claim(job_dir, task):
+        return False
+    try:
+        function(result_path)
+    except Exception as e:
+        with open(os.path.join(job_dir, task + ".failed"), "w") as f:
+            f.write(f"{socket.gethostname()} {os.getpid()}: {e}\n")
+        raise
+    return True
+
+
+def wait_for(job_dir, tasks, paths):
+    """Blocks until every path exists; raises if the task producing one of them failed on any worker."""
+    while True:
+        for task in tasks:
+            failed = os.path.join(job_dir, task + ".failed")
+            if os.path.exists(failed):
+                with open(failed) as f:
+                    raise RuntimeError(f"Task {task} failed: {f.read().strip()}")
+        if all(os.path.exists(path) for path in paths):
+            return
+        time.sleep(POLL_INTERVAL)
+
+
+def motion_path(job_dir, k):
+    return os.path.join(job_dir, f"motion-{k:04d}.npy")
+
+
+def segment_video_path(job_dir, k, output_path):
+    return os.path.join(job_dir, f"segment-{k:04d}" + os.path.splitext(output_path)[1])
+
+
+def estimate_segment(job, k, result_path, threads=1):
+    """Raw frame transforms of segment k, decoded from its first frame on."""
+    start, end = job["segments"][k]
+    max_frames = None if end is None else end - start
+    started = time.perf_counter()
+    stabilizer = Stabilizer(None, estimation_workers=threads, estimation_scale=job["estimation_scale"],
+                            estimator=job["estimator"], skip_interval=job["skip_interval"])
+    frames = iter_decoded(job["video"], start=start, max_frames=max_frames)
+    transforms = stabilizer.get_frame_transforms(frames, max_frames)
+    if end is not None and len(transforms) != end - start - 1:
+        raise ValueError(f"Segment {k} decoded {len(transforms) + 1} of {end - start} frames.")
+    write_atomic(result_path, lambda f: np.save(f, transforms))
+    print(f"Segment {k + 1}/{len(job['segments'])}: motion of {len(transforms)} frame pairs "
+          f"in {time.perf_counter() - started:.1f}s.")
+
+
+def smooth_job(job, job_dir, result_path, threads=1):
+    """Stitches the segment transforms into the global path and smooths and crops it, as a single run would."""
+    segments = job["segments"]
+    path = stitch_paths(segments, [np.load(motion_path(job_dir, k)) for k in range(len(segments))])
+    frame_size = tuple(job["frame_size"])
+    smoothed_path, corrections = smooth_corrections(path, job["method"], job["sigma"], frame_size=frame_size,
+                                                    workers=threads)
+    corrections, output_size = crop_corrections(corrections, frame_size, job["crop"], job["output_size"])
+    write_atomic(result_path, lambda f: np.savez(f, path=path, smoothed_path=smoothed_path, corrections=corrections,
+                                                 output_size=np.array(output_size)))
+    print(f"Stitched and smoothed a path of {len(path)} frames.")
+
+
+def warp_range(job, corrections, output_size, start, end, result_path, threads=1):
+    """Warps and encodes frames [start, end) of the video to result_path."""
+    tmp_path = temporary_path(result_path)
+    writer = open_writer(tmp_path, output_size[0], output_size[1], job["fps"], job["fourcc"])
+    try:
+        written = warp_encode(job["video"], writer, corrections[start:end], threads, size=output_size, start=start)
+    finally:
+        writer.release()
+    if written != end - start:
+        os.remove(tmp_path)
+        raise ValueError(f"Wrote {written} of the {end - start} frames from frame {start}.")
+    os.replace(tmp_path, result_path)
+    print(f"Frames {start}-{end - 1}: warped and encoded.")
+
+
+def finish_output(job_dir, done_path, write_output):
+    """Writes the final output, then the marker the other workers wait for."""
+    write_output()
+    with open(done_path, "w") as f:
+        f.write(f"{socket.gethostname()} {os.getpid()}\n")
+
+
+def concat_segments(job_dir, paths, output_path):
+    list_path = os.path.join(job_dir, "segments.txt")
+    with open(list_path, "w") as f:
+        for path in paths:
+            f.write(f"file '{path}'\n")
+    tmp_path = temporary_path(output_path)
+    subprocess.run(concat_command(list_path, tmp_path), check=True)
+    os.replace(tmp_path, output_path)
+    print(f"Joined {len(paths)} segments into {output_path}.")
+
+
+def work(job_dir, threads=1):
+    """Runs whatever tasks of the job in job_dir are left, alongside any other workers (processes or
+    hosts) sharing the directory: motion estimation per segment, then one stitch-and-smooth task,
+    then warp + encode per segment and the final concatenation.
+
+    Tasks are claimed through files in job_dir, so workers can join at any time. A failed task is
+    recorded and stops everyone; a worker that dies leaves its claim behind, delete the .claim
+    files of unfinished tasks to retry them. Returns the number of tasks this worker ran."""
+    with open(os.path.join(job_dir, JOB_FILE)) as f:
+        job = json.load(f)
+    segments = job["segments"]
+    ran = 0
+
+    motion_tasks = [f"motion-{k:04d}" for k in range(len(segments))]
+    for k, task in enumerate(motion_tasks):
+        ran += run_task(job_dir, task, motion_path(job_dir, k),
+                        lambda result_path: estimate_segment(job, k, result_path, threads))
+    wait_for(job_dir, motion_tasks, [motion_path(job_dir, k) for k in range(len(segments))])
+
+    smooth_path = os.path.join(job_dir, SMOOTH_FILE)
+    ran += run_task(job_dir, "smooth", smooth_path, lambda result_path: smooth_job(job, job_dir, result_path, threads))
+    wait_for(job_dir, ["smooth"], [smooth_path])
+    smoothed = np.load(smooth_path)
+    corrections = smoothed["corrections"]
+    output_size = tuple(int(v) for v in smoothed["output_size"])
+    output_path = job["output"]
+    done_path = os.path.join(job_dir, DONE_FILE)
+
+    if not can_concat():
+        # Segment files can only be joined without re-encoding by ffmpeg; without it one worker
+        # encodes the whole video in a single pipelined pass instead
+        print("ffmpeg not found: the output is encoded in one pass instead of per segment.")
+        ran += run_task(job_dir, "encode", done_path,
+                        lambda result_path: finish_output(job_dir, result_path, lambda: warp_range(
+                            job, corrections, output_size, 0, len(corrections), output_path, threads)))
+        return ran
+
+    ranges = owned_ranges(segments, len(corrections))
+    warp_tasks = [f"warp-{k:04d}" for k in range(len(ranges))]
+    segment_paths = [segment_video_path(job_dir, k, output_path) for k in range(len(ranges))]
+    for k, (task, (start, end)) in enumerate(zip(warp_tasks, ranges)):
+        ran += run_task(job_dir, task, segment_paths[k],
+                        lambda result_path: warp_range(job, corrections, output_size, start, end, result_path,
+                                                       threads))
+    wait_for(job_dir, warp_tasks, segment_paths)
+    ran += run_task(job_dir, "concat", done_path,
+                    lambda result_path: finish_output(job_dir, result_path,
+                                                      lambda: concat_segments(job_dir, segment_paths, output_path)))
+    return ran
+
+
+def run_segmented(video_path, output_path, workers=None, job_dir=None, segment_frames=DEFAULT_SEGMENT_FRAMES,
+                  overlap=DEFAULT_OVERLAP, method="Gaussian", sigma=50, crop="Autocrop", output_size=None,
+                  estimation_scale=None, fourcc=DEFAULT_FOURCC, threads=1, estimator=DEFAULT_ESTIMATOR,
+                  skip_interval=DEFAULT_SKIP_INTERVAL):
+    """Plans a job and works it off with local worker processes. Returns (n_frames, seconds).
+
+    The job directory (a temporary one by default) is removed afterwards unless it was given."""
+    start = time.perf_counter()
+    if workers is None or workers < 1:
+        workers = os.cpu_count() or 1
+    keep_job_dir = job_dir is not None
+    if job_dir is None:
+        job_dir = tempfile.mkdtemp(prefix="videostab-job-", dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        job = prepare_job(video_path, output_path, job_dir, segment_frames, overlap, method, sigma, crop,
+                          output_size, estimation_scale, fourcc, estimator, skip_interval)
+        workers = min(workers, len(job["segments"]))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=init_process, initargs=(threads,)) as pool:
+            for future in [pool.submit(work, job_dir, threads) for _ in range(workers)]:
+                future.result()
+        if not os.path.exists(job["output"]):
+            raise IOError(f"The job in {job_dir} is done but its output '{job['output']}' is missing; "
+                          f"delete the job directory (or its '{DONE_FILE}' file) to write it again.")
+        n_frames = len(np.load(os.path.join(job_dir, SMOOTH_FILE))["corrections"])
+    finally:
+        if not keep_job_dir:
+            shutil.rmtree(job_dir, ignore_errors=True)
+    return n_frames, time.perf_counter() - start
+
+
+def add_job_arguments(parser):
+    parser.add_argument("--segment-frames", type=int, default=DEFAULT_SEGMENT_FRAMES,
+                        help=f"Frames per segment (default: {DEFAULT_SEGMENT_FRAMES})")
+    parser.add_argument("--overlap", type=int, default=DEFAULT_OVERLAP,
+                        help=f"Frames shared by consecutive segments (default: {DEFAULT_OVERLAP})")
+    parser.add_argument("--method", choices=SMOOTHING_METHODS, default="Gaussian",
+                        help="Smoothing method (default: Gaussian)")
+    parser.add_argument("--sigma", type=float, default=50, help="Smoothing factor (default: 50)")
+    parser.add_argument("--crop", choices=CROP_MODES, default="Autocrop", help="Crop mode (default: Autocrop)")
+    parser.add_argument("--output-size", type=parse_frame_size, default=None,
+                        help="Output frame size WIDTHxHEIGHT (default: input size)")
+    parser.add_argument("--estimation-scale", type=float, default=None,
+                        help="Downscale factor for motion estimation (default: automatic, ~1080p)")
+    parser.add_argument("--estimator", choices=list(ESTIMATORS), default=DEFAULT_ESTIMATOR,
+                        help="Motion estimator (default: LK)")
+    parser.add_argument("--skip-interval", type=int, default=DEFAULT_SKIP_INTERVAL,
+                        help="Estimate low-motion stretches only every this many frames (default: 1, every frame)")
+    parser.add_argument("--fourcc", default=DEFAULT_FOURCC, help=f"Output codec (default: {DEFAULT_FOURCC})")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m videostab.Segments",
+                                     description="Stabilize a long video as overlapping segments, on local "
+                                                 "processes or on several hosts sharing a job directory.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Plan a job and run it with local worker processes")
+    run.add_argument("input", help="Input video file")
+    run.add_argument("output", help="Output video file")
+    run.add_argument("-j", "--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    run.add_argument("--job-dir", default=None, help="Keep the job files here (default: a temporary directory)")
+    add_job_arguments(run)
+
+    plan = commands.add_parser("plan", help="Write a job to a shared directory for 'work' to pick up")
+    plan.add_argument("input", help="Input video file (at a path every worker host can read)")
+    plan.add_argument("output", help="Output video file (at a path every worker host can write)")
+    plan.add_argument("--job-dir", required=True, help="Shared job directory")
+    add_job_arguments(plan)
+
+    work_parser = commands.add_parser("work", help="Work on the job in a shared directory until it is done")
+    work_parser.add_argument("job_dir", help="Shared job directory")
+
+    for command in (run, work_parser):
+        command.add_argument("--threads", type=int, default=1,
+                             help="Estimation/warp threads per worker process (default: 1)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "work":
+        cv.setNumThreads(args.threads)
+        print(f"Ran {work(args.job_dir, args.threads)} task(s).")
+        return 0
+    options = dict(segment_frames=args.segment_frames, overlap=args.overlap, method=args.method, sigma=args.sigma,
+                   crop=args.crop, output_size=args.output_size, estimation_scale=args.estimation_scale,
+                   fourcc=args.fourcc, estimator=args.estimator, skip_interval=args.skip_interval)
+    if args.command == "plan":
+        prepare_job(args.input, args.output, args.job_dir, **options)
+        return 0
+    n_frames, seconds = run_segmented(args.input, args.output, args.workers, args.job_dir, threads=args.threads,
+                                      **options)
+    print(f"OK {args.input}: {n_frames} frames in {seconds:.2f}s ({n_frames / seconds:.1f} frames/s)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+from scipy.optimize import brentq
+from scipy.signal import fftconvolve, lfilter, lfilter_zi
+
+# Gaussian smoothing engines for (N, 3) camera paths. All of them extend the path past its ends by
+# mirroring it (scipy's 'reflect' mode: d c b a | a b c d | d c b a) over the kernel radius, so they
+# only differ in how the kernel is applied:
+#   direct  exact truncated kernel, O(N * sigma) (scipy.ndimage.gaussian_filter1d)
+#   fft     exact truncated kernel, O(N log N) whatever sigma
+#   iir     3rd-order recursive approximation run forwards and backwards, O(N) whatever sigma
+#   box     three cumulative-sum moving averages of matched widths, O(N) whatever sigma
+# The approximations have the exact variance and stay within about 2% of the Gaussian's shape.
+SMOOTHING_ENGINES = ("auto", "direct", "fft", "iir", "box")
+# Kernel radius in sigmas, as gaussian_filter1d's default truncate
+TRUNCATE = 4.0
+# auto: the direct kernel is the fastest up to this sigma ...
+DIRECT_MAX_SIGMA = 8
+# ... then the FFT, as long as the mirrored path is at most this long, then the recursive filter
+FFT_MAX_SAMPLES = 1 << 18
+
+# Poles of the recursive Gaussian (van Vliet, Young & Verbeek, 1998); scaled as d ** (1 / q) for sigma
+IIR_BASE_POLES = np.array([1.40098 + 1.00236j, 1.40098 - 1.00236j, 1.85132])
+
+
+def kernel_radius(sigma):
+    return int(TRUNCATE * sigma + 0.5)
+
+
+def mirror(path, radius):
+    """path extended by radius mirrored samples at both ends (repeatedly, when radius > len(path))."""
+    return np.pad(path, ((radius, radius), (0, 0)), mode='symmetric')
+
+
+def choose_engine(n, sigma):
+    """Fastest engine for a path of n samples: exact ones while they are cheap, the recursive filter beyond."""
+    if sigma <= DIRECT_MAX_SIGMA:
+        return "direct"
+    if n + 2 * kernel_radius(sigma) <= FFT_MAX_SAMPLES:
+        return "fft"
+    return "iir"
+
+
+def gaussian_direct(path, sigma):
+    return gaussian_filter1d(path, sigma=sigma, axis=0, mode='reflect', truncate=TRUNCATE)
+
+
+def gaussian_fft(path, sigma):
+    radius = kernel_radius(sigma)
+    offsets = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * (offsets / sigma) ** 2)
+    kernel /= kernel.sum()
+    return fftconvolve(mirror(path, radius), kernel[:, None], mode='valid', axes=0)
+
+
+def iir_coefficients(sigma):
+    """(b, a) of the causal half of the recursive Gaussian, unit DC gain.
+
+    The base poles are scaled so that the forward-backward filter has exactly variance sigma²;
+    unlike the closed-form q(sigma) of Young & van Vliet (1995) this holds for any sigma."""
+    def variance(q):
+        d = IIR_BASE_POLES ** (1 / q)
+        return np.sum(2 * d / (d - 1) ** 2).real
+
+    q = brentq(lambda q: variance(q) - sigma ** 2, 0.1, 10 * sigma + 10)
+    a = np.poly(1 / IIR_BASE_POLES ** (1 / q)).real
+    return np.array([a.sum()]), a
+
+
+def gaussian_iir(path, sigma):
+    b, a = iir_coefficients(sigma)
+    radius = kernel_radius(sigma)
+    # Centred, so the filter starts from steady state on values near zero
+    mean = path.mean(axis=0)
+    padded = mirror(path - mean, radius)
+    zi = lfilter_zi(b, a)[:, None]
+    forward, _ = lfilter(b, a, padded, axis=0, zi=zi * padded[:1])
+    backward, _ = lfilter(b, a, forward[::-1], axis=0, zi=zi * forward[-1:])
+    return backward[::-1][radius:radius + len(path)] + mean
+
+
+def box_widths(sigma, passes=3):
+    """Odd widths of the moving averages whose cascade has variance closest to sigma² (Kovesi, 2010)."""
+    ideal = np.sqrt(12 * sigma ** 2 / passes + 1)
+    lower = int(ideal) - (int(ideal) % 2 == 0)
+    n_lower = round((12 * sigma ** 2 - passes * lower ** 2 - 4 * passes * lower - 3 * passes) / (-4 * lower - 4))
+    n_lower = min(max(n_lower, 0), passes)
+    return [lower] * n_lower + [lower + 2] * (passes - n_lower)
+
+
+def gaussian_box(path, sigma):
+    widths = box_widths(sigma)
+    # Centred, so the running sums stay small on long paths
+    mean = path.mean(axis=0)
+    smoothed = mirror(path - mean, sum((width - 1) // 2 for width in widths))
+    for width in widths:
+        sums = np.concatenate([np.zeros((1, smoothed.shape[1])), np.cumsum(smoothed, axis=0)])
+        smoothed = (sums[width:] - sums[:-width]) / width
+    return smoothed + mean
+
+
+ENGINE_FUNCTIONS = {"direct": gaussian_direct, "fft": gaussian_fft, "iir": gaussian_iir, "box": gaussian_box}
+
+
+def gaussian_smooth(path, sigma, engine="auto"):
+    """Smooths every column of an (N, 3) path at once with a Gaussian of sigma frames.
+
+    engine is one of SMOOTHING_ENGINES; "auto" picks one from the path length and sigma."""
+    path = np.asarray(path, dtype=np.float64)
+    if len(path) == 0 or sigma <= 0:
+        return path.copy()
+    if engine == "auto":
+        engine = choose_engine(len(path), sigma)
+    if engine not in ENGINE_FUNCTIONS:
+        raise ValueError(f"Unknown smoothing engine '{engine}' (choose from {', '.join(SMOOTHING_ENGINES)})")
+    return ENGINE_FUNCTIONS[engine](path, sigma)
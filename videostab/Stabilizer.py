@@ -0,0 +1,515 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import numpy as np
+
+import Utils
+from videostab.Crop import crop_corrections
+from videostab.Estimators import (DEFAULT_ESTIMATOR, DEFAULT_SKIP_INTERVAL, DUPLICATE_MAX_MOTION, FEATURE_PARAMS,
+                                  LK_PARAMS, PHASE_MAX_SIDE, PHASE_MIN_RESPONSE, RANSAC_REPROJ_THRESHOLD,
+                                  REDETECT_GRID, REDETECT_MIN_POINTS, SKIP_MAX_MOTION, SKIP_THUMBNAIL_SIDE,
+                                  FrameSkipper, auto_estimation_scale, make_estimator)
+from videostab.Export import open_writer, remove_partial
+from videostab.Instrumentation import NULL_RECORDER
+from videostab.Pipeline import iter_decoded, warp_encode
+from videostab.TransformCache import make_key, video_content_hash
+from videostab.Trajectory import decompose_cumulative, identity_transforms, smooth_corrections
+from videostab.Warp import StabilizedFrames, warp_frames
+
+# The tracker starts from fresh detections every this many pairs. This bounds drift and fixes
+# where parallel estimation may split the pairs, so it matches the sequential result exactly.
+TRACK_SEGMENT_PAIRS = 30
+
+
+class StabilizationCancelled(Exception):
+    """Raised by Stabilizer.stabilize() once its cancel event is set.
+
+    transforms holds the raw frame transforms of the pairs estimated before that, in order, so a
+    new run of the same video can resume from them (Stabilizer(resume_transforms=...))."""
+
+    def __init__(self, transforms):
+        super().__init__("Stabilization cancelled.")
+        self.transforms = transforms
+
+
+class Stabilizer:
+    """Qt-free stabilization pipeline: motion estimation, trajectory smoothing and warping.
+
+    Shared by the GUI worker (ui/StabilizationWorker.py) and the headless CLI (python -m videostab).
+    progress is an optional callable(message, percent)."""
+
+    def __init__(self, frames, method="Gaussian", crop="Autocrop", sigma=50, video_path=None, output_path=None,
+                 progress=None, estimation_workers=1, estimation_scale=None, warp_workers=1, transform_cache=None,
+                 lazy_warp=False, recorder=None, cancel=None, resume_transforms=None, output_size=None,
+                 estimator=DEFAULT_ESTIMATOR, skip_interval=DEFAULT_SKIP_INTERVAL):
+        self.method = method
+        # "Autocrop" folds a crop to the largest border-free window into the corrections, "None" keeps borders
+        self.crop = crop
+        # Output (width, height); defaults to the input frame size
+        self.output_size = output_size
+        self.sigma = sigma  # Smoothing factor
+        self.frames = frames
+        # Streaming mode: when both paths are set the video is decoded twice from disk
+        # (motion pass + warp pass) and written straight to output_path, so memory stays
+        # bounded by a few frames no matter how long the video is.
+        self.video_path = video_path
+        self.output_path = output_path
+        self.progress = progress
+        # Threads used for motion estimation; 1 keeps the original sequential loop
+        self.estimation_workers = max(1, estimation_workers or 1)
+        # Motion is estimated on luma downscaled by this factor (None picks it from the frame size)
+        self.estimation_scale = estimation_scale
+        # Motion estimator backend, a name in videostab.Estimators.ESTIMATORS
+        self.estimator = estimator
+        # Low-motion stretches are estimated only every this many pairs and interpolated (1 = every pair)
+        self.skip_interval = max(1, skip_interval or 1)
+        # Threads used for warping; frames are independent and warpAffine releases the GIL
+        self.warp_workers = max(1, warp_workers or 1)
+        # Optional videostab.TransformCache; raw transforms are looked up by video content + parameters
+        # (only when video_path is known), so re-runs with other smoothing settings skip motion estimation
+        self.transform_cache = transform_cache
+        # In-memory mode only: return a StabilizedFrames view that warps frames on demand instead of
+        # materializing every stabilized frame
+        self.lazy_warp = lazy_warp
+        # Optional videostab.Instrumentation.Recorder collecting stage/frame timings and tracking counters
+        self.recorder = recorder if recorder is not None else NULL_RECORDER
+        # Optional threading.Event; when set, the run stops between frames with StabilizationCancelled
+        self.cancel = cancel
+        # Raw transforms of the first pairs of this video from an earlier, cancelled run (same
+        # estimation parameters), which motion estimation continues from instead of starting over
+        self.resume_transforms = resume_transforms
+
+        # Results storage
+        self.frame_transforms = None  # Raw transforms between frames, (N-1, 2, 3)
+        self.optimal_correction_transforms = None  # Transforms to apply for stabilization, (N, 2, 3)
+        self.path = None  # Raw cumulative (dx, dy, dr) path, (N, 3)
+        self.smoothed_path = None  # Smoothed path, (N, 3)
+        self.stabilized_frames = None  # The final output images
+
+    def report_progress(self, message, percent):
+        if self.progress is not None:
+            self.progress(message, percent)
+
+    def is_streaming(self):
+        return self.video_path is not None and self.output_path is not None
+
+    def is_cancelled(self):
+        return self.cancel is not None and self.cancel.is_set()
+
+    def check_cancelled(self):
+        if self.is_cancelled():
+            transforms = self.frame_transforms if self.frame_transforms is not None else identity_transforms(0)
+            raise StabilizationCancelled(transforms)
+
+    def has_enough_frames(self):
+        return self.is_streaming() or (self.frames is not None and len(self.frames) > 1)
+
+    def stabilize(self):
+        """Runs motion estimation, smoothing and warping. Raises on failure.
+
+        Returns the number of frames processed. Results are left on the instance
+        (frame_transforms, optimal_correction_transforms, path, smoothed_path, stabilized_frames)."""
+        if not self.has_enough_frames():
+            raise ValueError("Not enough frames to stabilize.")
+
+        print("Stabilization started")
+        self.report_progress("Calculating motion...", 10)
+
+        # --- 1. Get Transforms ---
+        cache_key = self.transform_cache_key()
+        self.frame_transforms = self.load_cached_transforms(cache_key)
+        if self.frame_transforms is None:
+            with self.recorder.span("motion"):
+                if self.is_streaming():
+                    # Pass 1: frames are decoded ahead on a background thread, only the previous estimation frame is kept
+                    expected_frames, _, _, _ = Utils.get_video_properties(self.video_path)
+                    frames = iter_decoded(self.video_path, recorder=self.recorder)
+                    self.frame_transforms = self.get_frame_transforms(frames, expected_frames)
+                else:
+                    self.frame_transforms = self.get_frame_transforms()
+            self.store_cached_transforms(cache_key)
+        self.check_cancelled()
+
+        if self.is_streaming():
+            # The container frame count is only a hint, trust what was actually decoded
+            n_frames = len(self.frame_transforms) + 1
+            if n_frames <= 1:
+                raise ValueError("Not enough frames to stabilize.")
+        else:
+            n_frames = len(self.frames)
+        if len(self.frame_transforms) == 0 or len(self.frame_transforms) != n_frames - 1:
+            raise ValueError("Failed to compute sufficient  transforms.")
+        print(f"Computed {len(self.frame_transforms)}  transforms.")
+        self.report_progress("Decomposing motion...", 40)
+
+        # --- 2. Decompose into Cumulative Paths ---
+        # decompose_cumulative returns an (n_frames, 3) path
+        self.path = decompose_cumulative(self.frame_transforms)
+        if len(self.path) != n_frames:
+            raise ValueError("Cumulative path length mismatch.")
+        print("Decomposed cumulative paths.")
+        self.report_progress("Calculating smoothed path...", 60)
+
+        # --- 3. Calculate Optimal Correction Transforms (Smoothing) ---
+        # This calculates N correction transforms (one for each frame including the first)
+        with self.recorder.span("smooth"):
+            self.smoothed_path, corrections = smooth_corrections(
+                self.path, self.method, self.sigma, frame_size=self.frame_size(), workers=self.estimation_workers)
+            # Crop and rescale are part of each frame's warp matrix, so every frame is resampled once
+            self.optimal_correction_transforms, self.output_size = crop_corrections(
+                corrections, self.frame_size(), self.crop, self.output_size)
+
+        if self.optimal_correction_transforms is None or len(self.optimal_correction_transforms) != n_frames:
+            raise ValueError("Failed to compute sufficient correction transforms.")
+        print(f"Calculated {len(self.optimal_correction_transforms)} correction transforms.")
+        self.report_progress("Applying stabilization warp...", 80)
+
+        # --- 4. Apply Correction Transforms to Generate Stabilized Frames ---
+        if self.is_streaming():
+            # Pass 2: decode again, warp and encode each frame as it comes (pipelined stages)
+            with self.recorder.span("warp pass"):
+                written = self.write_stabilized_video(self.video_path, self.output_path,
+                                                      self.optimal_correction_transforms)
+            if self.is_cancelled():
+                remove_partial(self.output_path)
+                self.check_cancelled()
+            if written != n_frames:
+                raise ValueError("Failed to write sufficient stabilized frames.")
+            self.stabilized_frames = []
+            print(f"Wrote {written} stabilized frames to {self.output_path}.")
+        elif self.lazy_warp:
+            self.stabilized_frames = StabilizedFrames(self.frames, self.optimal_correction_transforms,
+                                                      size=self.output_size)
+            print("Stabilized frames will be warped on demand.")
+        else:
+            with self.recorder.span("warp pass"):
+                self.stabilized_frames = self.apply_warp(self.frames, self.optimal_correction_transforms)
+            self.check_cancelled()
+            if not self.stabilized_frames or len(self.stabilized_frames) != n_frames:
+                raise ValueError("Failed to generate sufficient stabilized frames.")
+            print(f"Generated {len(self.stabilized_frames)} stabilized frames.")
+        self.report_progress("Stabilization complete.", 100)
+
+        return n_frames
+
+    def transform_cache_key(self):
+        """Key of this video + estimation parameters in the transform cache, or None when not cacheable."""
+        if self.transform_cache is None or self.video_path is None:
+            return None
+        width, height = self.frame_size()
+        scale = self.get_estimation_scale((height, width))
+        return make_key(video_content_hash(self.video_path),
+                        estimation_params(scale, self.estimator, self.skip_interval))
+
+    def frame_size(self):
+        """(width, height) of the input frames."""
+        if self.frames is not None and len(self.frames) > 0:
+            height, width = self.frames[0].shape[:2]
+            return width, height
+        _, _, width, height = Utils.get_video_properties(self.video_path)
+        return width, height
+
+    def load_cached_transforms(self, cache_key):
+        if cache_key is None:
+            return None
+        transforms = self.transform_cache.load(cache_key)
+        if transforms is None:
+            return None
+        if self.frames is not None and not self.is_streaming() and len(transforms) != len(self.frames) - 1:
+            print("Warning: cached transforms don't match the loaded frames. Recomputing.")
+            return None
+        print(f"Loaded {len(transforms)} transforms from the transform cache.")
+        return transforms
+
+    def store_cached_transforms(self, cache_key):
+        if cache_key is None or len(self.frame_transforms) == 0:
+            return
+        try:
+            self.transform_cache.store(cache_key, self.frame_transforms)
+        except OSError as e:
+            # A cache that can't be written must not fail the stabilization itself
+            print(f"Warning: could not write the transform cache: {e}")
+
+    def apply_warp(self, original_frames, correction_transforms):
+        """Applies the correction transforms to the original frames, on warp_workers threads."""
+        n_frames = len(original_frames)
+
+        if len(correction_transforms) != n_frames:
+            print(
+                f"Warning: Mismatch frame count ({n_frames}) and correction transforms ({len(correction_transforms)})")
+            return original_frames  # Return original if transforms are wrong length
+
+        def warp_progress(done, total):
+            # Emit progress
+            if done % 10 == 0:
+                percent = 80 + int((done / total) * 20)  # Scale 80-100%
+                self.report_progress(f"Warping frame {done}/{total}", percent)
+
+        return warp_frames(original_frames, correction_transforms, self.warp_workers, warp_progress, self.recorder,
+                           self.cancel, self.output_size)
+
+    def write_stabilized_video(self, video_path, output_path, correction_transforms):
+        """Re-decodes video_path, warps every frame and encodes it straight to output_path.
+
+        Decode, warp and encode run concurrently (see videostab.Pipeline). Returns the number of frames written."""
+        _, fps, width, height = Utils.get_video_properties(video_path)
+        width, height = self.output_size or (width, height)
+        out = open_writer(output_path, width, height, fps)
+
+        def write_progress(done, total):
+            if done % 10 == 0:
+                percent = 80 + int((done / total) * 20)  # Scale 80-100%
+                self.report_progress(f"Writing frame {done}/{total}", percent)
+
+        try:
+            return warp_encode(video_path, out, correction_transforms, self.warp_workers, progress=write_progress,
+                               recorder=self.recorder, cancel=self.cancel, size=(width, height))
+        finally:
+            out.release()
+
+    def get_frame_transforms(self, frames=None, n_frames=None):
+        """Calculates the transform from frame i to frame i+1, as an (N-1, 2, 3) float32 array.
+
+        frames can be any iterable (e.g. Utils.iter_video), it is consumed once and only the
+        previous grayscale image is kept. n_frames is only used for progress reporting.
+        With estimation_workers > 1 the frame pairs are estimated on a thread pool.
+
+        Estimation continues from resume_transforms when set, and stops between frames when the
+        cancel event is set, raising StabilizationCancelled with the transforms done so far."""
+        if frames is None:
+            frames = self.frames
+        if frames is None: return identity_transforms(0)
+        if n_frames is None and hasattr(frames, '__len__'):
+            n_frames = len(frames)
+
+        # Resume at the last tracker segment boundary of the earlier run: the tracker restarts
+        # there anyway, so the result is the same as estimating every pair again
+        resumed = []
+        if self.resume_transforms is not None and len(self.resume_transforms) > 0:
+            if n_frames and len(self.resume_transforms) >= n_frames - 1:
+                return np.asarray(self.resume_transforms[:n_frames - 1])
+            start = len(self.resume_transforms) // TRACK_SEGMENT_PAIRS * TRACK_SEGMENT_PAIRS
+            resumed = list(self.resume_transforms[:start])
+        start = len(resumed)
+
+        if self.estimation_workers > 1:
+            # Sources that decode on access (FrameSource) are cheaper to read sequentially
+            if hasattr(frames, '__getitem__') and hasattr(frames, '__len__') and getattr(frames, 'random_access', True):
+                frame_transforms = self.get_frame_transforms_chunked(frames, start)
+            else:
+                frame_transforms = self.get_frame_transforms_windowed(frames_from(frames, start), n_frames, start)
+        else:
+            frame_transforms = self.get_frame_transforms_sequential(frames_from(frames, start), n_frames, start)
+
+        frame_transforms = resumed + frame_transforms
+        if self.is_cancelled():
+            raise StabilizationCancelled(np.array(frame_transforms).reshape(-1, 2, 3))
+        if not frame_transforms:
+            return identity_transforms(0)
+        return np.stack(frame_transforms)
+
+    def get_frame_transforms_sequential(self, frames, n_frames=None, start=0):
+        """Estimates pairs start, start+1, ... of frames (which begins at frame start) one by one."""
+        frame_transforms = []
+
+        frames = iter(frames)
+        first_frame = next(frames, None)
+        if first_frame is None: return []
+
+        scale = self.get_estimation_scale(first_frame.shape)
+        recorder = self.recorder
+        estimator = FrameSkipper(make_estimator(self.estimator, scale, recorder), self.skip_interval, recorder)
+        with recorder.span("prepare", start):
+            old = estimator.prepare(first_frame)
+
+        for i, frame in enumerate(frames, start):  # N-1 iterations for N frames
+            if self.is_cancelled():
+                break
+            # Each frame's gray image (and pyramid) is built once: as "new" here and reused as "old"
+            # for the next pair, then dropped
+            with recorder.span("prepare", i + 1):
+                new = estimator.prepare(frame)
+            if i % TRACK_SEGMENT_PAIRS == 0:
+                frame_transforms.extend(estimator.flush())
+                estimator.reset()
+            frame_transforms.extend(estimator.push(old, new, i))
+
+            # Update old frame for next iteration (no copy, new is never modified)
+            old = new
+
+            self.report_tracking_progress(i + 1, n_frames)
+
+        frame_transforms.extend(estimator.flush())
+        return frame_transforms
+
+    def get_frame_transforms_chunked(self, frames, start=0):
+        """Parallel estimation for random-access frames: pairs start..N-2 are split into contiguous
+        chunks, one per task, and the per-pair transforms are merged back in order.
+
+        Chunk boundaries fall on tracker segment boundaries (start must be one) so the result
+        matches the sequential path. When cancelled, only the finished prefix of pairs is returned."""
+        n_frames = len(frames)
+        n_pairs = n_frames - 1 - start
+        if n_pairs <= 0: return []
+        scale = self.get_estimation_scale(frames[0].shape)
+
+        # A few chunks per worker keeps the pool busy when some chunks are slower than others
+        n_segments = -(-n_pairs // TRACK_SEGMENT_PAIRS)
+        n_chunks = min(n_segments, self.estimation_workers * 4)
+        bounds = np.linspace(0, n_segments, n_chunks + 1).astype(int) * TRACK_SEGMENT_PAIRS
+        bounds[-1] = n_pairs
+        bounds += start
+        chunks = [(bounds[k], bounds[k + 1]) for k in range(n_chunks) if bounds[k] < bounds[k + 1]]
+
+        frame_transforms = []
+        with ThreadPoolExecutor(max_workers=self.estimation_workers) as pool:
+            futures = [pool.submit(estimate_chunk_transforms, frames, first, end, scale, self.recorder, self.cancel,
+                                   self.estimator, self.skip_interval)
+                       for first, end in chunks]
+            for (first, end), future in zip(chunks, futures):  # In submission order, so the transforms stay ordered
+                transforms = future.result()
+                frame_transforms.extend(transforms)
+                self.report_tracking_progress(start + len(frame_transforms), n_frames)
+                if len(transforms) < end - first:
+                    break  # Cancelled, later chunks stop on their first pair
+
+        return frame_transforms
+
+    def get_frame_transforms_windowed(self, frames, n_frames=None, start=0):
+        """Parallel estimation for frame streams: estimation frames are buffered one tracker segment
+        at a time and each segment is submitted as soon as it is complete. At most one segment per
+        worker is in flight so memory stays bounded.
+
+        frames begins at frame start (a tracker segment boundary). When cancelled, only the
+        finished prefix of pairs is returned."""
+        frames = iter(frames)
+        first_frame = next(frames, None)
+        if first_frame is None: return []
+
+        max_in_flight = self.estimation_workers + 1
+        frame_transforms = []
+        pending = deque()
+
+        scale = self.get_estimation_scale(first_frame.shape)
+        recorder = self.recorder
+        cancelled = False
+
+        def collect(future, expected):
+            # Pairs after a segment cut short by cancellation are dropped, so the result stays contiguous
+            nonlocal cancelled
+            transforms = future.result()
+            if not cancelled:
+                frame_transforms.extend(transforms)
+                self.report_tracking_progress(start + len(frame_transforms), n_frames)
+            cancelled = cancelled or len(transforms) < expected
+
+        # Frames are prepared here, in order, and each segment is estimated by an estimator of its own
+        preparer = FrameSkipper(make_estimator(self.estimator, scale, recorder), self.skip_interval, recorder)
+        with ThreadPoolExecutor(max_workers=self.estimation_workers) as pool:
+            with recorder.span("prepare", start):
+                segment = [preparer.prepare(first_frame)]
+            segment_start = start
+            for i, frame in enumerate(frames, start):
+                if self.is_cancelled():
+                    break
+                with recorder.span("prepare", i + 1):
+                    segment.append(preparer.prepare(frame))
+
+                if len(segment) > TRACK_SEGMENT_PAIRS:
+                    pending.append((pool.submit(estimate_segment_transforms, segment, segment_start, scale, recorder,
+                                                self.cancel, self.estimator, self.skip_interval), len(segment) - 1))
+                    # The last image of a segment is the first one of the next
+                    segment = [segment[-1]]
+                    segment_start = i + 1
+
+                if len(pending) >= max_in_flight:
+                    collect(*pending.popleft())
+
+            if len(segment) > 1 and not self.is_cancelled():
+                pending.append((pool.submit(estimate_segment_transforms, segment, segment_start, scale, recorder,
+                                            self.cancel, self.estimator, self.skip_interval), len(segment) - 1))
+
+            while pending:
+                collect(*pending.popleft())
+
+        return frame_transforms
+
+    def get_estimation_scale(self, frame_shape):
+        """The configured estimation scale, or one picked from the frame shape (h, w, ...) when it is None."""
+        if self.estimation_scale is not None:
+            return self.estimation_scale
+        return auto_estimation_scale(frame_shape[1], frame_shape[0])
+
+    def report_tracking_progress(self, done_pairs, n_frames):
+        if n_frames and n_frames > 1:
+            percent = 10 + int(min(done_pairs / (n_frames - 1), 1.0) * 30)
+            self.report_progress(f"Tracking frame {done_pairs}/{n_frames - 1}", percent)
+
+
+def frames_from(frames, start):
+    """Iterator over frames[start:]: sources that can seek (FrameSource.iter_from) or index skip the
+    first frames instead of decoding them."""
+    if start == 0:
+        return frames
+    if hasattr(frames, 'iter_from'):
+        return frames.iter_from(start)
+    if hasattr(frames, '__getitem__') and hasattr(frames, '__len__'):
+        return (frames[i] for i in range(start, len(frames)))
+    return islice(frames, start, None)
+
+
+def estimation_params(scale, estimator=DEFAULT_ESTIMATOR, skip_interval=DEFAULT_SKIP_INTERVAL):
+    """Everything that determines the raw transforms of a given video, for the transform cache key."""
+    params = dict(features=FEATURE_PARAMS, lk=LK_PARAMS, ransac_reproj_threshold=RANSAC_REPROJ_THRESHOLD,
+                  redetect_min_points=REDETECT_MIN_POINTS, redetect_grid=REDETECT_GRID,
+                  track_segment_pairs=TRACK_SEGMENT_PAIRS, scale=scale,
+                  # Transforms from the tracker that seeded LK with the previous motion don't match
+                  lk_initial_flow=False)
+    if estimator != DEFAULT_ESTIMATOR:  # Only the other estimators add keys, LK runs keep the plain LK key
+        params.update(estimator=estimator, phase_max_side=PHASE_MAX_SIDE, phase_min_response=PHASE_MIN_RESPONSE)
+    if skip_interval != DEFAULT_SKIP_INTERVAL:
+        params.update(skip_interval=skip_interval, skip_max_motion=SKIP_MAX_MOTION,
+                      duplicate_max_motion=DUPLICATE_MAX_MOTION, skip_thumbnail_side=SKIP_THUMBNAIL_SIDE)
+    return params
+
+
+def estimate_chunk_transforms(frames, start, end, scale=1.0, recorder=NULL_RECORDER, cancel=None,
+                              estimator=DEFAULT_ESTIMATOR, skip_interval=DEFAULT_SKIP_INTERVAL):
+    """Transforms for the pairs start..end-1 of a random-access frame sequence.
+
+    start must be a multiple of TRACK_SEGMENT_PAIRS. Stops early (fewer transforms) once cancel is set."""
+    transforms = []
+    estimator = FrameSkipper(make_estimator(estimator, scale, recorder), skip_interval, recorder)
+    if cancel is not None and cancel.is_set():
+        return transforms
+    with recorder.span("prepare", start):
+        old = estimator.prepare(frames[start])
+    for i in range(start, end):
+        if cancel is not None and cancel.is_set():
+            break
+        with recorder.span("prepare", i + 1):
+            new = estimator.prepare(frames[i + 1])
+        if i % TRACK_SEGMENT_PAIRS == 0:
+            transforms.extend(estimator.flush())
+            estimator.reset()
+        transforms.extend(estimator.push(old, new, i))
+        old = new
+    transforms.extend(estimator.flush())
+    return transforms
+
+
+def estimate_segment_transforms(segment, start, scale=1.0, recorder=NULL_RECORDER, cancel=None,
+                                estimator=DEFAULT_ESTIMATOR, skip_interval=DEFAULT_SKIP_INTERVAL):
+    """Transforms between consecutive prepared frames of one tracker segment (pairs start..start+len-2).
+
+    Stops early (fewer transforms) once cancel is set."""
+    estimator = FrameSkipper(make_estimator(estimator, scale, recorder), skip_interval, recorder)
+    transforms = []
+    for k in range(len(segment) - 1):
+        if cancel is not None and cancel.is_set():
+            break
+        transforms.extend(estimator.push(segment[k], segment[k + 1], start + k))
+    transforms.extend(estimator.flush())
+    return transforms
+
@@ -0,0 +1,192 @@
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+from scipy import sparse
+from scipy.optimize import linprog
+
+from videostab.Smoothing import gaussian_smooth
+
+# Camera paths are (N, 3) float64 arrays with columns (dx, dy, dr); transforms are (N, 2, 3) affine stacks.
+IDENTITY_AFFINE = np.array([[1, 0, 0], [0, 1, 0]], dtype=np.float32)
+
+# Smoothing methods smooth_corrections supports
+SMOOTHING_METHODS = ("Gaussian", "L1")
+
+# L1-optimal path: weights of the first, second and third derivative terms (Grundmann et al., 2011),
+# which favour constant, then linear, then parabolic segments
+L1_WEIGHTS = (10.0, 1.0, 100.0)
+# The path is optimised in windows of this many frames, each overlapping the next
+L1_WINDOW = 300
+L1_OVERLAP = 60
+# Below this many window LPs, starting worker processes costs more than it saves
+L1_PARALLEL_MIN_WINDOWS = 16
+# Crop-window constraints: the correction may shift a frame by at most this fraction of its size,
+# and rotate it by at most this many radians
+L1_CROP_MARGIN = 0.1
+L1_MAX_ROTATION = 0.1
+
+
+def identity_transforms(n):
+    return np.tile(IDENTITY_AFFINE, (n, 1, 1))
+
+
+def decompose_cumulative(transforms):
+    """Cumulative (dx, dy, dr) camera path of N frames from the N-1 frame-to-frame transforms.
+
+    transforms is an (N-1, 2, 3) or (N-1, 3, 3) array (or a list of such matrices). The first
+    frame is the reference point, so path[0] is 0."""
+    transforms = np.asarray(transforms, dtype=np.float64)
+    if transforms.size == 0:
+        transforms = np.zeros((0, 2, 3))
+    path = np.zeros((len(transforms) + 1, 3))
+    path[1:, 0] = np.cumsum(transforms[:, 0, 2])
+    path[1:, 1] = np.cumsum(transforms[:, 1, 2])
+    path[1:, 2] = np.cumsum(np.arctan2(transforms[:, 1, 0], transforms[:, 0, 0]))
+    return path
+
+
+@lru_cache(maxsize=8)
+def l1_window_lp(n, n_columns=1):
+    """Sparse LP of a window of n samples of n_columns independent path columns, in equality form.
+
+    Per column the variables are [p (n), u_k, v_k (n-k each, k = 1..3)] with D_k p = u_k - v_k and
+    u, v >= 0, so minimising sum(w_k * (u_k + v_k)) minimises sum(w_k * |D_k p|). The columns form
+    a block-diagonal problem. Returns (objective, A_eq), b_eq = 0."""
+    sizes = [n - k for k in (1, 2, 3)]
+    n_slack = sum(sizes)
+    rows = []
+    offset = 0
+    for k, size in enumerate(sizes, 1):
+        # k-th forward difference operator
+        coefficients = [(-1) ** (k - j) * math.comb(k, j) for j in range(k + 1)]
+        difference = sparse.diags(coefficients, list(range(k + 1)), shape=(size, n), dtype=np.float64)
+        slack = sparse.eye(size, n_slack, k=offset)
+        rows.append(sparse.hstack([difference, -slack, slack]))
+        offset += size
+    weights = np.concatenate([np.full(size, weight) for weight, size in zip(L1_WEIGHTS, sizes)])
+    objective = np.concatenate([np.zeros(n), weights, weights])
+    constraints = sparse.vstack(rows)
+    return np.tile(objective, n_columns), sparse.block_diag([constraints] * n_columns, format="csr")
+
+
+def solve_l1_window(values, bounds, head=None, tail=None):
+    """L1-optimal smoothing of an (n, k) window of a path, column c staying within bounds[c] of the raw values.
+
+    head / tail pin the first / last rows of the solution (to join it to its neighbours). The columns
+    are solved as one block-diagonal LP, much cheaper than one LP per column."""
+    n, n_columns = values.shape
+    if n < 4:
+        return values.copy()
+    objective, constraints = l1_window_lp(n, n_columns)
+    stride = len(objective) // n_columns
+    # Positions of the path variables p, as an (n, k) index array
+    path_index = np.arange(n)[:, None] + stride * np.arange(n_columns)[None, :]
+
+    variable_bounds = np.zeros((len(objective), 2))
+    variable_bounds[:, 1] = np.inf
+    low, high = values - bounds, values + bounds
+    if head is not None:
+        low[:len(head)] = high[:len(head)] = head
+    if tail is not None:
+        low[n - len(tail):] = high[n - len(tail):] = tail
+    variable_bounds[path_index, 0] = low
+    variable_bounds[path_index, 1] = high
+
+    result = linprog(objective, A_eq=constraints, b_eq=np.zeros(constraints.shape[0]), bounds=variable_bounds,
+                     method="highs-ds", options={"presolve": False})
+    if result.status != 0:
+        raise ValueError(f"L1 path optimisation failed: {result.message}")
+    return result.x[path_index]
+
+
+def l1_windows(n, window=L1_WINDOW, overlap=L1_OVERLAP):
+    """(start, end) of the windows covering n samples, each overlapping the next by overlap."""
+    if n <= window:
+        return [(0, n)]
+    step = window - overlap
+    return [(start, min(n, start + window)) for start in range(0, n - overlap, step)]
+
+
+def solve_all(jobs, workers):
+    """solve_l1_window(*job) for every job, on worker processes when there are enough of them."""
+    if workers > 1 and len(jobs) >= L1_PARALLEL_MIN_WINDOWS:
+        # Spawned, not forked: the caller may be a multi-threaded GUI process
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            return list(pool.map(solve_l1_window, *zip(*jobs), chunksize=4))
+    return [solve_l1_window(*job) for job in jobs]
+
+
+def l1_smooth(path, frame_size=None, workers=1, window=L1_WINDOW, overlap=L1_OVERLAP):
+    """L1-optimal (N, 3) camera path: piecewise constant, linear and parabolic segments.
+
+    With frame_size (width, height) the smoothed path stays within L1_CROP_MARGIN of the frame size
+    (and L1_MAX_ROTATION) of the raw path, so a fixed crop window hides the corrections' borders.
+
+    The solver scales superlinearly, so the path is solved as many small sparse LPs instead of one
+    big one: overlapping windows are solved independently and cut in the middle of their overlaps,
+    then a short LP across every cut, pinned to 3 samples on each side, re-joins the pieces with
+    continuous derivatives. Both passes are independent LPs, so long paths are solved on `workers`
+    processes.
+
+    The cost stays linear in the path length, but each window LP still takes about 60 ms: one
+    process smooths 1500 to 2500 frames/s (20k frames in about 8 s, 100k in 40 to 70 s). Long paths
+    only solve in seconds when spread over many processes."""
+    path = np.asarray(path, dtype=np.float64)
+    n = len(path)
+    if frame_size is None:
+        bounds = np.array([np.inf, np.inf, L1_MAX_ROTATION])
+    else:
+        bounds = np.array([L1_CROP_MARGIN * frame_size[0], L1_CROP_MARGIN * frame_size[1], L1_MAX_ROTATION])
+
+    windows = l1_windows(n, window, overlap)
+    solutions = solve_all([(path[start:end], bounds) for start, end in windows], workers)
+    cuts = [start + overlap // 2 for start, _ in windows[1:]]
+    smoothed = np.empty_like(path)
+    for (start, _), cut_start, cut_end, solution in zip(windows, [0] + cuts, cuts + [n], solutions):
+        smoothed[cut_start:cut_end] = solution[cut_start - start:cut_end - start]
+
+    # Re-join the pieces across each cut
+    seams = [(max(0, cut - overlap), min(n, cut + overlap)) for cut in cuts]
+    repaired = solve_all([(path[start:end], bounds, smoothed[start:start + 3], smoothed[end - 3:end])
+                          for start, end in seams], workers)
+    for (start, end), solution in zip(seams, repaired):
+        smoothed[start:end] = solution
+    return smoothed
+
+
+def smooth_corrections(path, method="Gaussian", sigma=50, frame_size=None, workers=1):
+    """Smoothed path and (N, 2, 3) correction transforms for a raw (N, 3) path.
+
+    method is 'Gaussian' (sigma) or 'L1' (crop constraints from frame_size (width, height), if given,
+    solved on `workers` processes).
+    Cheap compared to motion estimation, so it can be re-run whenever the smoothing settings change."""
+    if method == 'Gaussian':
+        smoothed_path = gaussian_smooth(path, sigma)
+        return smoothed_path, path_corrections(path, smoothed_path)
+    if method == 'L1':
+        smoothed_path = l1_smooth(path, frame_size, workers)
+        return smoothed_path, path_corrections(path, smoothed_path)
+    # If no smoothing, smoothed path is the same as raw path
+    return path, identity_transforms(len(path))
+
+
+def path_corrections(path, smoothed_path):
+    """(N, 2, 3) correction transforms that move each frame from path onto smoothed_path.
+
+    diff = smoothed - raw is applied to the *original* frame as a rotation plus translation."""
+    diff = np.asarray(smoothed_path) - np.asarray(path)
+    cos_r = np.cos(diff[:, 2])
+    sin_r = np.sin(diff[:, 2])
+
+    # Affine matrix: [[cos(r), -sin(r), tx], [sin(r), cos(r), ty]]
+    corrections = np.empty((len(diff), 2, 3), dtype=np.float32)
+    corrections[:, 0, 0] = cos_r
+    corrections[:, 0, 1] = -sin_r
+    corrections[:, 0, 2] = diff[:, 0]
+    corrections[:, 1, 0] = sin_r
+    corrections[:, 1, 1] = cos_r
+    corrections[:, 1, 2] = diff[:, 1]
+    return corrections
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+# Bump when the estimator changes in a way the parameters don't capture
+CACHE_FORMAT_VERSION = 1
+DEFAULT_MAX_BYTES = 1 << 30  # 1 GiB
+# Content hash: the file size plus this many evenly spaced blocks (always including head and tail)
+HASH_BLOCKS = 64
+HASH_BLOCK_SIZE = 1 << 16
+
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "videostab", "transforms")
+
+
+def video_content_hash(path):
+    """Hash of a video file's content, independent of its name and location.
+
+    Hashing every byte of a multi-gigabyte file would cost a good part of what the cache saves,
+    so the size plus HASH_BLOCKS evenly spaced 64 KiB blocks are hashed instead."""
+    size = os.path.getsize(path)
+    digest = hashlib.blake2b(str(size).encode(), digest_size=20)
+    with open(path, "rb") as f:
+        if size <= HASH_BLOCKS * HASH_BLOCK_SIZE:
+            digest.update(f.read())
+        else:
+            for offset in np.linspace(0, size - HASH_BLOCK_SIZE, HASH_BLOCKS).astype(np.int64):
+                f.seek(int(offset))
+                digest.update(f.read(HASH_BLOCK_SIZE))
+    return digest.hexdigest()
+
+
+def make_key(content_hash, params):
+    """Cache key from a video content hash and the (JSON-serialisable) estimation parameters."""
+    payload = json.dumps({"version": CACHE_FORMAT_VERSION, "video": content_hash, "params": params},
+                         sort_keys=True, default=str)
+    return hashlib.blake2b(payload.encode(), digest_size=20).hexdigest()
+
+
+class TransformCache:
+    """On-disk cache of raw frame-to-frame transforms, one compressed .npz per key.
+
+    Safe to share between processes: entries are written to a temporary file and atomically
+    renamed into place, so readers never see partial files, and readers and evictors treat a
+    file vanishing under them as a miss. Hits refresh the file's mtime; when the cache grows
+    past max_bytes the least recently used entries are deleted."""
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def load(self, key):
+        """The cached (N-1, 2, 3) transforms for key, or None on a miss."""
+        path = self.entry_path(key)
+        try:
+            with np.load(path) as data:
+                transforms = data["transforms"]
+            os.utime(path)  # Mark as recently used
+        except (OSError, KeyError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f"Warning: ignoring unreadable transform cache entry {path}: {e}")
+            return None
+        return transforms
+
+    def store(self, key, transforms):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez_compressed(f, transforms=np.asarray(transforms, dtype=np.float32))
+            os.replace(tmp_path, self.entry_path(key))
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        self.evict()
+
+    def evict(self):
+        """Deletes least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue  # Evicted by another process
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,186 @@
+import math
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2 as cv
+import numpy as np
+
+from videostab.FrameStore import FrameStore
+from videostab.Instrumentation import NULL_RECORDER
+
+
+def is_translation(transform):
+    """True when the 2x3 transform has no rotation or scale."""
+    return transform[0, 0] == 1 and transform[1, 1] == 1 and transform[0, 1] == 0 and transform[1, 0] == 0
+
+
+def translate_frame(frame, tx, ty, dst=None):
+    """Pure-translation fast path for warpAffine with a BORDER_CONSTANT black border.
+
+    Only the part of the output that maps inside the source is resampled (bilinear, via
+    getRectSubPix, about twice as fast as warpAffine); integer shifts are plain copies and match
+    warpAffine exactly. With a fractional shift, the one-pixel strip along the uncovered edges whose
+    source lies less than a pixel outside the frame is left black, where warpAffine blends the edge
+    pixels with black."""
+    h, w = frame.shape[:2]
+    out = np.zeros_like(frame) if dst is None else dst
+
+    # Output pixels whose source position (x - tx, y - ty) lies inside the frame
+    x0, x1 = max(0, math.ceil(tx)), min(w - 1, math.floor(w - 1 + tx))
+    y0, y1 = max(0, math.ceil(ty)), min(h - 1, math.floor(h - 1 + ty))
+    if x0 > x1 or y0 > y1:
+        out[...] = 0
+        return out
+
+    if dst is not None:
+        # Only the border strips need clearing, the rest is overwritten below
+        out[:y0] = 0
+        out[y1 + 1:] = 0
+        out[y0:y1 + 1, :x0] = 0
+        out[y0:y1 + 1, x1 + 1:] = 0
+
+    if tx == int(tx) and ty == int(ty):
+        sx, sy = x0 - int(tx), y0 - int(ty)
+        out[y0:y1 + 1, x0:x1 + 1] = frame[sy:sy + y1 - y0 + 1, sx:sx + x1 - x0 + 1]
+    else:
+        center = ((x0 + x1) / 2 - tx, (y0 + y1) / 2 - ty)
+        out[y0:y1 + 1, x0:x1 + 1] = cv.getRectSubPix(frame, (x1 - x0 + 1, y1 - y0 + 1), center)
+    return out
+
+
+def warp_frame(frame, transform, index=None, dst=None, size=None):
+    """Applies a 2x3 correction transform, falling back to a copy of the original on OpenCV errors.
+
+    The output is size (width, height), by default the frame's own (crop and rescale are folded
+    into the transform, see videostab.Crop). When dst is given the result is written into it and
+    returned; its shape sets the output size."""
+    h, w = frame.shape[:2]
+    if dst is not None:
+        size = (dst.shape[1], dst.shape[0])
+    elif size is None:
+        size = (w, h)
+    try:
+        if is_translation(transform) and size == (w, h):
+            return translate_frame(frame, float(transform[0, 2]), float(transform[1, 2]), dst)
+        # Apply the correction transform to the frame
+        return cv.warpAffine(frame, transform, size, dst=dst, flags=cv.INTER_LINEAR,
+                             borderMode=cv.BORDER_CONSTANT)  # Add border handling
+    except cv.error as e:
+        print(f"Error warping frame {index}: {e}. Appending original frame.")
+        if size != (w, h):
+            return cv.resize(frame, size, dst=dst)
+        if dst is None:
+            return frame.copy()  # Append original on error
+        dst[...] = frame
+        return dst
+
+
+def warp_frames(frames, transforms, workers=1, progress=None, recorder=NULL_RECORDER, cancel=None, size=None):
+    """Warps a random-access sequence of frames on a bounded thread pool.
+
+    warpAffine releases the GIL, so frames are warped concurrently. Every result is written through
+    dst into one preallocated FrameStore (spilled to disk when too big for RAM), returned in frame
+    order. progress is an optional callable(done, total), called from this thread. Once the optional
+    threading.Event cancel is set no further frames are warped (the result is then incomplete).
+    size is the output (width, height), by default the input frame size."""
+    n_frames = len(frames)
+    if n_frames == 0:
+        return []
+    shape = frames[0].shape
+    if size is not None:
+        shape = (size[1], size[0]) + shape[2:]
+    output = FrameStore(n_frames, shape, frames[0].dtype)
+    output.count = n_frames  # Every slot is written below
+
+    def warp_into(i):
+        if cancel is not None and cancel.is_set():
+            return
+        with recorder.span("warp", i):
+            warp_frame(frames[i], transforms[i], i, output.buffer[i])
+
+    if workers <= 1:
+        for i in range(n_frames):
+            if cancel is not None and cancel.is_set():
+                break
+            warp_into(i)
+            if progress is not None:
+                progress(i + 1, n_frames)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for done, future in enumerate([pool.submit(warp_into, i) for i in range(n_frames)], 1):
+                future.result()
+                if progress is not None:
+                    progress(done, n_frames)
+
+    return output
+
+
+class StabilizedFrames:
+    """Virtual sequence of stabilized frames: source[i] warped by transforms[i], computed on demand.
+
+    Only the original frames and the correction transforms are held. Recently requested frames
+    are kept in a small LRU cache around the playhead; set_transforms() swaps in new corrections
+    (e.g. after re-smoothing) and drops the cache, so only the frames displayed next get warped.
+    size is the output (width, height), by default the source frame size."""
+
+    def __init__(self, source, transforms, cache_size=8, size=None):
+        self.source = source
+        self.transforms = transforms
+        self.size = size
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        # Frames may be requested from a prerender thread as well as the GUI thread
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return min(len(self.source), len(self.transforms))
+
+    def __getitem__(self, index):
+        transforms = self.current_transforms()
+        n_frames = min(len(self.source), len(transforms))
+        if index < 0:
+            index += n_frames
+        if not 0 <= index < n_frames:
+            raise IndexError(index)
+
+        frame = self.cached(index, transforms)
+        if frame is not None:
+            return frame
+        frame = warp_frame(self.source[index], transforms[index], index, size=self.size)
+        self.store(index, transforms, frame)
+        return frame
+
+    def __iter__(self):
+        # One set of transforms for the whole pass, even if re-smoothed meanwhile. Sequential
+        # consumers (e.g. export) only read the cache, so they don't evict the playhead
+        transforms = self.current_transforms()
+        for i in range(min(len(self.source), len(transforms))):
+            frame = self.cached(i, transforms)
+            yield frame if frame is not None else warp_frame(self.source[i], transforms[i], i, size=self.size)
+
+    def current_transforms(self):
+        with self.lock:
+            return self.transforms
+
+    def cached(self, index, transforms):
+        """The cached frame index warped by transforms, or None."""
+        with self.lock:
+            if transforms is not self.transforms:  # The cache holds frames of newer transforms
+                return None
+            frame = self.cache.get(index)
+            if frame is not None:
+                self.cache.move_to_end(index)
+            return frame
+
+    def store(self, index, transforms, frame):
+        with self.lock:
+            if transforms is self.transforms:  # Not re-smoothed while warping
+                self.cache[index] = frame
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+    def set_transforms(self, transforms):
+        with self.lock:
+            self.transforms = transforms
+            self.cache.clear()
@@ -0,0 +1 @@
+"""Qt-free stabilization core shared by the GUI and the headless command line (python -m videostab)."""
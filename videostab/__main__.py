@@ -0,0 +1,72 @@
+import argparse
+import glob
+import sys
+
+from videostab.Batch import run_batch
+from videostab.Crop import CROP_MODES
+from videostab.Estimators import DEFAULT_ESTIMATOR, DEFAULT_SKIP_INTERVAL, ESTIMATORS
+from videostab.Online import parse_frame_size
+from videostab.TransformCache import DEFAULT_MAX_BYTES
+from videostab.Trajectory import SMOOTHING_METHODS
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m videostab",
+                                     description="Headless batch video stabilizer.")
+    parser.add_argument("inputs", nargs="+", help="Input video files (glob patterns are expanded)")
+    parser.add_argument("-o", "--output-dir", required=True, help="Directory for the stabilized videos")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Number of worker processes (default: CPU count)")
+    parser.add_argument("--method", choices=SMOOTHING_METHODS, default="Gaussian",
+                        help="Smoothing method (default: Gaussian)")
+    parser.add_argument("--sigma", type=float, default=50, help="Smoothing factor (default: 50)")
+    parser.add_argument("--crop", choices=CROP_MODES, default="Autocrop",
+                        help="Autocrop zooms in on the largest window without black borders (default: Autocrop)")
+    parser.add_argument("--output-size", type=parse_frame_size, default=None,
+                        help="Output frame size WIDTHxHEIGHT, folded into the warp (default: input size)")
+    parser.add_argument("--cv-threads", type=int, default=None,
+                        help="OpenCV threads per worker process (default: CPU count / jobs)")
+    parser.add_argument("--estimation-workers", type=int, default=None,
+                        help="Motion estimation threads per worker process (default: same as --cv-threads)")
+    parser.add_argument("--estimation-scale", type=float, default=None,
+                        help="Downscale factor for motion estimation (default: automatic, ~1080p)")
+    parser.add_argument("--estimator", choices=list(ESTIMATORS), default=DEFAULT_ESTIMATOR,
+                        help="Motion estimator: LK (features + RANSAC), Phase (phase correlation, translation "
+                             "only) or Hybrid (Phase, LK where its confidence is low) (default: LK)")
+    parser.add_argument("--skip-interval", type=int, default=DEFAULT_SKIP_INTERVAL,
+                        help="Estimate low-motion stretches only every this many frames and interpolate in "
+                             "between; repeated frames get the identity (default: 1, every frame)")
+    parser.add_argument("--warp-workers", type=int, default=None,
+                        help="Warp threads per worker process (default: same as --cv-threads)")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Reuse motion transforms from this directory (shared safely between processes)")
+    parser.add_argument("--cache-max-mb", type=float, default=DEFAULT_MAX_BYTES / (1 << 20),
+                        help="Transform cache size limit, least recently used entries are evicted")
+    parser.add_argument("--trace-dir", default=None,
+                        help="Instrument the runs: write a Chrome trace per file here and print timing summaries")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # Shells that don't expand globs (cmd.exe) pass the pattern through as-is
+    input_paths = []
+    for pattern in args.inputs:
+        input_paths.extend(sorted(glob.glob(pattern)) or [pattern])
+
+    failures = run_batch(input_paths, args.output_dir, jobs=args.jobs, method=args.method,
+                         sigma=args.sigma, cv_threads=args.cv_threads,
+                         estimation_workers=args.estimation_workers,
+                         estimation_scale=args.estimation_scale,
+                         warp_workers=args.warp_workers, cache_dir=args.cache_dir,
+                         cache_max_bytes=int(args.cache_max_mb * (1 << 20)), trace_dir=args.trace_dir,
+                         crop=args.crop, output_size=args.output_size, estimator=args.estimator,
+                         skip_interval=args.skip_interval)
+    if failures:
+        print(f"{failures}/{len(input_paths)} file(s) failed.")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())